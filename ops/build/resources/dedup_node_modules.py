@@ -5,25 +5,88 @@ After `bench setup requirements --node` + `bench build`, every app gets its
 own node_modules/ directory.  This script reduces image size by:
 
   1. **Dedup** – Identical packages (same name + version) across apps are
-     replaced with relative symlinks to a single canonical copy.
+     replaced with relative symlinks to a single canonical copy.  With
+     ``--verify-content`` only byte-identical copies are merged;
+     ``--by-content`` groups by content digest instead of name + version.
+     ``--strategy hardlink|reflink`` keeps every package directory and
+     links identical files instead (hardlinks share bytes within one
+     image layer; reflinks share extents on btrfs/XFS, e.g. a dev volume).
   2. **Clean** – Unnecessary files (tests, source maps, docs, CI configs)
      are removed from ALL node_modules trees (including nested ones).
 
 Run AFTER `bench build` so the build can resolve packages normally.
 
+All trees are scanned exactly once (``os.scandir``, one ``stat`` per file)
+into an in-memory index.  Every phase works from that index and keeps it
+in sync with what it changes on disk, so no phase walks the trees again.
+
 Usage:
-    python3 dedup_node_modules.py <apps-directory>
+    python3 dedup_node_modules.py [--jobs N] [--verify-content | --by-content]
+                                  [--strategy symlink|hardlink|reflink] [--dedup-only]
+                                  [--hoist | --hoist-strict]
+                                  [--plan] [--report FILE] [--top N]
+                                  [--incremental [--manifest FILE]] [--config PYPROJECT]
+                                  [--prune-unreachable [--entry PATH ...]]
+                                  [--node-store DIR] [--verify]
+                                  <apps-directory>
+
+``--hoist`` additionally collapses near-duplicates (``lodash@4.17.20`` next
+to ``4.17.21``) onto the newest copy every dependent's semver range
+accepts; ``--hoist-strict`` refuses substitutions across a major version.
+
+``--plan`` runs every phase against the in-memory index only – later
+phases see what earlier ones would have removed – and prints a JSON
+report (per-phase and per-package savings, largest remaining packages).
+``--report FILE`` writes the same report after a real run.
+
+``--prune-unreachable`` (release images) additionally removes every
+package not reachable from the Node entry points the image runs
+(frappe's socketio.js and realtime handlers) and explains what it keeps.
+
+``--node-store DIR`` finally moves the shared, stable packages (those
+other apps symlink to, locked with an integrity hash and byte-identical
+wherever installed) into ``DIR/node_modules`` and links to them there,
+so the release image can ``COPY`` them as their own layer; app rebuilds
+then leave that layer untouched.  A package only moves if everything
+it requires moves with it (Node resolves from the real path).
+
+Every run ends by resolving every symlink in the trees.  Dangling links
+are repaired where possible (re-pointed to a surviving copy of the same
+package, dangling ``.bin`` entries removed); a copy that other links
+still use is promoted into their place instead of being deleted.
+Cycles and unrepairable links make the script exit with status 1.
+``--verify`` runs only this check, e.g. on a finished image.  The
+top-level packages of every app are also cross-checked against the
+app's yarn.lock; versions the lock does not account for are reported as
+warnings.
+
+``--incremental`` keeps a manifest of each run next to ``apps/``.  The
+next run only merges and hoists packages that are new or changed since
+then, and skips package.json reads, content hashing and SBOM re-parsing
+for everything unchanged.
 
 Example:
     python3 dedup_node_modules.py /home/iqa/bench/apps
 """
 
+import argparse
+import contextlib
+import fnmatch
+import hashlib
 import json
 import os
+import re
 import shutil
 import sys
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
+from typing import Callable, NamedTuple
+
+import npm_semver  # sibling module (same directory as this script)
+import yarn_lock
 
 # ---------------------------------------------------------------------------
 # Cleanup configuration
@@ -76,6 +139,111 @@ REMOVE_EXTENSIONS = {
     ".markdown",
 }
 
+# pyproject.toml section with project-specific additions / exceptions:
+#
+#   [tool.ops.overrides.node-modules-cleanup]
+#   remove-dirs = ["docs"]          # extra directory names (globs)
+#   remove-files = ["*.d.ts"]       # extra file names (globs)
+#   keep-dirs = []                  # never removed, beats any remove rule
+#   keep-files = ["LICENSE*"]
+CLEANUP_SECTION = ("tool", "ops", "overrides", "node-modules-cleanup")
+
+
+def _read_toml_section(path: Path, *keys: str) -> dict | None:
+    """Read a nested section from a TOML file, returning None if absent."""
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib  # type: ignore[no-redef]
+        except ImportError:
+            return None
+    try:
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+    except (OSError, tomllib.TOMLDecodeError):
+        return None
+    for key in keys:
+        data = data.get(key, {})
+        if not isinstance(data, dict):
+            return None
+    return data or None
+
+
+def _has_magic(pattern: str) -> bool:
+    return any(c in pattern for c in "*?[")
+
+
+class _NameMatcher:
+    """A list of glob patterns compiled for fast matching of one name.
+
+    Plain names go into a set, ``*suffix`` / ``prefix*`` patterns into
+    tuples for ``str.endswith`` / ``str.startswith`` (one C call each) and
+    anything else into a single combined regex.
+    """
+
+    __slots__ = ("exact", "prefixes", "suffixes", "regex")
+
+    def __init__(self, patterns):
+        exact, prefixes, suffixes, other = set(), [], [], []
+        for pattern in patterns:
+            if not _has_magic(pattern):
+                exact.add(pattern)
+            elif pattern.startswith("*") and not _has_magic(pattern[1:]):
+                suffixes.append(pattern[1:])
+            elif pattern.endswith("*") and not _has_magic(pattern[:-1]):
+                prefixes.append(pattern[:-1])
+            else:
+                other.append(fnmatch.translate(pattern))
+        self.exact = frozenset(exact)
+        self.prefixes = tuple(prefixes)
+        self.suffixes = tuple(suffixes)
+        self.regex = re.compile("|".join(other)).match if other else None
+
+    def __call__(self, name: str) -> bool:
+        return (name in self.exact
+                or name.endswith(self.suffixes)
+                or name.startswith(self.prefixes)
+                or (self.regex is not None and self.regex(name) is not None))
+
+
+class CleanupRules:
+    """Compiled cleanup rules: which directory / file names clean() removes.
+
+    Built from the module defaults plus the optional pyproject.toml
+    section (see ``CLEANUP_SECTION``); ``keep-*`` patterns win over every
+    remove rule.
+    """
+
+    def __init__(self, remove_dirs=(), remove_files=(), keep_dirs=(), keep_files=()):
+        self._remove_dir = _NameMatcher(remove_dirs)
+        self._remove_file = _NameMatcher(remove_files)
+        self._keep_dir = _NameMatcher(keep_dirs)
+        self._keep_file = _NameMatcher(keep_files)
+
+    @classmethod
+    def default(cls, section: dict | None = None) -> "CleanupRules":
+        """Module defaults, extended by a ``node-modules-cleanup`` *section*."""
+        section = section or {}
+        return cls(
+            remove_dirs=[*REMOVE_DIRS, *section.get("remove-dirs", [])],
+            remove_files=[*REMOVE_FILE_GLOBS, *(f"*{ext}" for ext in REMOVE_EXTENSIONS),
+                          *section.get("remove-files", [])],
+            keep_dirs=section.get("keep-dirs", []),
+            keep_files=section.get("keep-files", []),
+        )
+
+    @classmethod
+    def from_pyproject(cls, path: Path) -> "CleanupRules":
+        """Defaults plus the section from *path* (missing file/section → defaults)."""
+        return cls.default(_read_toml_section(path, *CLEANUP_SECTION))
+
+    def match_dir(self, name: str) -> bool:
+        return self._remove_dir(name) and not self._keep_dir(name)
+
+    def match_file(self, name: str) -> bool:
+        return self._remove_file(name) and not self._keep_file(name)
+
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
@@ -90,24 +258,163 @@ def _read_pkg_meta(pkg_json: Path) -> tuple[str | None, str | None]:
     correctly during deduplication.
     """
     try:
-        if pkg_json.is_file():
-            data = json.loads(pkg_json.read_text())
-            return data.get("name"), data.get("version")
-    except (json.JSONDecodeError, OSError):
+        data = json.loads(pkg_json.read_text())
+        return data.get("name"), data.get("version")
+    except (json.JSONDecodeError, OSError, AttributeError):
         pass
     return None, None
 
 
-def _dir_size(path: Path) -> int:
-    """Return total size (bytes) of all regular files under *path*."""
-    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+def _pmap(fn, items: list, jobs: int) -> list:
+    """``map()`` over a thread pool when *jobs* > 1.
+
+    Results are returned in input order regardless of completion order.
+    """
+    if jobs <= 1 or len(items) < 2:
+        return list(map(fn, items))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(fn, items))
+
+
+# ioctl(FICLONE) from <linux/fs.h>: share extents between two files (CoW)
+_FICLONE = 0x40049409
+
+
+def _reflink(src: Path, dst: Path) -> None:
+    """Create *dst* as a copy-on-write clone of *src* (btrfs, XFS, …).
+
+    Raises OSError (EOPNOTSUPP, EXDEV, EINVAL) if the filesystem cannot
+    share extents.
+    """
+    import fcntl  # Linux only
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    shutil.copymode(src, dst)
+
+
+def _reflink_supported(directory: Path) -> bool:
+    """Probe whether *directory*'s filesystem can clone files."""
+    src = directory / ".dedup-reflink-probe"
+    dst = directory / ".dedup-reflink-probe.clone"
+    try:
+        src.write_bytes(b"probe")
+        _reflink(src, dst)
+        return True
+    except (OSError, ImportError):
+        return False
+    finally:
+        src.unlink(missing_ok=True)
+        dst.unlink(missing_ok=True)
 
 
 # ---------------------------------------------------------------------------
-# 1. Find all node_modules trees
+# 0. Filesystem index (one scandir pass over apps/)
 # ---------------------------------------------------------------------------
 
 
+class FileStat(NamedTuple):
+    """The part of a file's ``stat`` the index keeps."""
+    size: int
+    ino: int
+    mtime_ns: int
+
+
+class Node:
+    """A real directory inside a node_modules tree.
+
+    ``files`` maps file name → :class:`FileStat`, ``links`` maps symlink name →
+    link target and ``dirs`` maps sub-directory name → Node.  Symlinks are
+    recorded but never followed.  Package directories additionally carry
+    the npm ``name`` / ``version`` read from their package.json.
+    """
+
+    __slots__ = ("path", "parent", "files", "links", "dirs", "removed",
+                 "npm_name", "version")
+
+    def __init__(self, path: Path, parent: "Node | None" = None):
+        self.path = path
+        self.parent = parent
+        self.files: dict[str, FileStat] = {}
+        self.links: dict[str, str] = {}
+        self.dirs: dict[str, Node] = {}
+        self.removed = False
+        self.npm_name: str | None = None
+        self.version: str | None = None
+
+    @property
+    def key(self) -> tuple[str, str] | None:
+        """``(npm name, version)`` for package directories, else None."""
+        if self.npm_name and self.version:
+            return self.npm_name, self.version
+        return None
+
+    @property
+    def label(self) -> str:
+        """``name@version`` for display (directory name if unkeyed)."""
+        if self.key:
+            return f"{self.npm_name}@{self.version}"
+        return self.path.name
+
+    def iter_tree(self):
+        """Yield this node and every live directory below it."""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.dirs.values())
+
+    def size(self) -> int:
+        """Total size (bytes) of all regular files in this subtree."""
+        return sum(f.size for n in self.iter_tree() for f in n.files.values())
+
+    def file_count(self) -> int:
+        """Number of regular files in this subtree."""
+        return sum(len(n.files) for n in self.iter_tree())
+
+
+def iter_packages(nm: Node):
+    """Yield package nodes directly inside the node_modules node *nm*.
+
+    Sorted by directory name, scoped packages (``@scope/name``) expanded in
+    place.  Hidden entries (``.bin``, ``.yarn-integrity``) and symlinks are
+    skipped.
+    """
+    for name in sorted(nm.dirs):
+        if name.startswith("."):
+            continue
+        child = nm.dirs[name]
+        if name.startswith("@"):
+            for sub in sorted(child.dirs):
+                yield child.dirs[sub]
+        else:
+            yield child
+
+
+def owning_package(node: Node) -> Node | None:
+    """Return the innermost package directory containing *node* (or itself)."""
+    while node.parent is not None:
+        parent = node.parent
+        if parent.path.name == "node_modules" and not node.path.name.startswith("@"):
+            return node
+        if (parent.path.name.startswith("@") and parent.parent is not None
+                and parent.parent.path.name == "node_modules"):
+            return node
+        node = parent
+    return None
+
+
+class Change(NamedTuple):
+    """One mutation applied (or, with ``--plan``, planned) by a phase."""
+    phase: str
+    action: str         # remove | symlink | link | move | promote | store | relink | remove-file | remove-link | rewrite
+    path: Path
+    package: str | None  # label of the owning package
+    bytes: int          # bytes freed
+    files: int          # regular files removed / linked / rewritten
+    target: Path | None = None
+
+
 def _is_top_level_nm(nm_dir: Path, apps_dir: Path) -> bool:
     """Return True if nm_dir is a top-level app node_modules.
 
@@ -122,6 +429,743 @@ def _is_top_level_nm(nm_dir: Path, apps_dir: Path) -> bool:
         return False
 
 
+class NodeModulesIndex:
+    """In-memory inventory of every node_modules tree under ``apps/``.
+
+    Built with a single ``os.scandir`` walk.  Records each directory, file
+    size and symlink, the npm name/version of every package directory
+    (top-level and nested) and which entries match the cleanup rules.
+
+    Phases mutate the filesystem only through :meth:`remove`,
+    :meth:`replace_with_symlink`, :meth:`remove_package`, :meth:`move`,
+    :meth:`make_dir`, :meth:`relink`, :meth:`link_file`, :meth:`remove_file`,
+    :meth:`remove_link` and :meth:`write_file`, which keep the index in sync and record a
+    :class:`Change` per call.  With ``dry_run`` set they update only the
+    index, so later phases see exactly what earlier ones would have left.
+    """
+
+    def __init__(self, apps_dir: Path):
+        self.apps_dir = apps_dir
+        self.trees: list[Node] = []
+        # Cleanup-rule matches, recorded while scanning
+        self.clean_dirs: list[Node] = []
+        self.clean_files: list[tuple[Node, str]] = []
+        self.jobs = 1
+        self.dry_run = False
+        self.phase = ""
+        self.changes: list[Change] = []
+        # path → name@version of every package removed or replaced so far
+        self.gone: dict[Path, str] = {}
+        self._fake_ino = 0
+        # Links per stored file (keyed by storage id, see _storage), built
+        # on first use: bytes are freed when the last link goes away
+        self._refs: Counter | None = None
+        # Reflinked inode → inode whose extents it shares
+        self._clones: dict[int, int] = {}
+        # (new path, old path) of every move made with dry_run set
+        self._moved: list[tuple[Path, Path]] = []
+        # Lexical link target → links, built on first use (see inbound_links)
+        self._links_to: dict[str, set[tuple[Node, str]]] | None = None
+
+    # -- building ----------------------------------------------------------
+
+    @classmethod
+    def build(cls, apps_dir: Path, jobs: int = 1, meta_cache: dict | None = None,
+              rules: CleanupRules | None = None,
+              store: Path | None = None) -> "NodeModulesIndex":
+        """Scan *apps_dir* and return the index.
+
+        With ``jobs > 1`` the subtrees below each node_modules root and the
+        package.json reads are fanned out over a thread pool (scandir/stat
+        release the GIL).  Results are merged in submission order, so the
+        index – and therefore canonical-copy selection – is identical to a
+        serial scan.
+
+        *meta_cache* maps a package path (relative to *apps_dir*) to
+        ``(FileStat, name, version)`` of its package.json; packages whose
+        package.json is unchanged are not re-read (see :class:`Manifest`).
+
+        *rules* decides which entries are recorded as cleanup candidates
+        (default: :meth:`CleanupRules.default`).
+
+        *store* adds ``<store>/node_modules`` as the last tree (see
+        :func:`move_to_store`); it need not exist yet.
+        """
+        index = cls(apps_dir)
+        index.jobs = jobs
+        scan = partial(index._scan_subtree, rules=rules or CleanupRules.default())
+        nm_paths = index._find_node_modules()
+        # Top-level first → they become canonical in dedup()
+        top_level = [p for p in nm_paths if _is_top_level_nm(p, apps_dir)]
+        sub_app = [p for p in nm_paths if not _is_top_level_nm(p, apps_dir)]
+        index.trees = [Node(p) for p in top_level + sub_app]
+        if store is not None:
+            index.trees.append(Node(store / "node_modules"))
+
+        # Tree roots serially (shallow), everything below them in parallel
+        results = [scan(tree, recursive=False) for tree in index.trees]
+        subtrees = [child for tree in index.trees for child in tree.dirs.values()]
+        results += _pmap(scan, subtrees, jobs)
+
+        nm_nodes = []
+        for clean_dirs, clean_files, nms in results:
+            index.clean_dirs.extend(clean_dirs)
+            index.clean_files.extend(clean_files)
+            nm_nodes.extend(nms)
+        index.clean_dirs.sort(key=lambda n: len(n.path.parts))
+
+        # Package dirs are fully scanned now → read their package.json
+        packages = []
+        for nm in nm_nodes:
+            for pkg in iter_packages(nm):
+                st = pkg.files.get("package.json")
+                if st is None:
+                    continue
+                cached = meta_cache.get(index.rel(pkg.path)) if meta_cache else None
+                if cached and cached[0] == st:
+                    pkg.npm_name, pkg.version = cached[1], cached[2]
+                else:
+                    packages.append(pkg)
+        metas = _pmap(_read_pkg_meta, [pkg.path / "package.json" for pkg in packages], jobs)
+        for pkg, (npm_name, version) in zip(packages, metas):
+            pkg.npm_name, pkg.version = npm_name, version
+        return index
+
+    def _find_node_modules(self) -> list[Path]:
+        """Return the outermost, non-symlinked node_modules dirs (sorted).
+
+        Walks apps/ without descending into node_modules itself – nested
+        trees (nm/pkg/node_modules) are indexed as part of their root tree.
+        """
+        found = []
+        stack = [self.apps_dir]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        try:
+                            if not entry.is_dir(follow_symlinks=False):
+                                continue
+                        except OSError:
+                            continue
+                        if entry.name == "node_modules":
+                            found.append(Path(entry.path))
+                        else:
+                            stack.append(entry.path)
+            except OSError:
+                continue
+        return sorted(found)
+
+    @staticmethod
+    def _scan_subtree(root: Node, recursive: bool = True, rules: CleanupRules | None = None):
+        """Index *root* (recursively by default), one scandir per directory.
+
+        Returns ``(clean_dirs, clean_files, nm_nodes)`` found while
+        scanning.  Only touches nodes below *root*, so disjoint subtrees
+        can be scanned concurrently.
+        """
+        match_dir = rules.match_dir if rules else lambda name: False
+        match_file = rules.match_file if rules else lambda name: False
+        clean_dirs: list[Node] = []
+        clean_files: list[tuple[Node, str]] = []
+        nm_nodes: list[Node] = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            try:
+                it = os.scandir(node.path)
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    name = entry.name
+                    try:
+                        if entry.is_symlink():
+                            node.links[name] = os.readlink(entry.path)
+                        elif entry.is_dir(follow_symlinks=False):
+                            child = Node(Path(entry.path), node)
+                            node.dirs[name] = child
+                            if recursive:
+                                stack.append(child)
+                            # Never a package itself (an npm package named "test")
+                            if match_dir(name) and not (node.path.name == "node_modules"
+                                                        or node.path.name.startswith("@")):
+                                clean_dirs.append(child)
+                        else:
+                            st = entry.stat(follow_symlinks=False)
+                            node.files[name] = FileStat(st.st_size, st.st_ino, st.st_mtime_ns)
+                            if match_file(name):
+                                clean_files.append((node, name))
+                    except OSError:
+                        continue
+            if node.path.name == "node_modules":
+                nm_nodes.append(node)
+        return clean_dirs, clean_files, nm_nodes
+
+    # -- queries -----------------------------------------------------------
+
+    @property
+    def nm_dirs(self) -> list[Path]:
+        return [tree.path for tree in self.trees]
+
+    def rel(self, path: Path) -> str:
+        """*path* relative to apps_dir (POSIX), for reports and the manifest."""
+        try:
+            return path.relative_to(self.apps_dir).as_posix()
+        except ValueError:
+            return str(path)
+
+    def disk_path(self, path: Path) -> Path:
+        """Where the file at index path *path* is on disk right now.
+
+        Only differs with ``dry_run``: directories moved in the index are
+        still at their old place, so phases read their files from there.
+        """
+        for new, old in reversed(self._moved):
+            if path.is_relative_to(new):
+                path = old / path.relative_to(new)
+        return path
+
+    def iter_nodes(self):
+        """Yield every live directory node in every tree."""
+        for tree in self.trees:
+            yield from tree.iter_tree()
+
+    def totals(self) -> tuple[int, int]:
+        """Return (bytes, files) of all live trees.
+
+        Hardlinks – and files reflinked by this run – count once.
+        """
+        seen: set[int] = set()
+        total_bytes = 0
+        total_files = 0
+        for node in self.iter_nodes():
+            for st in node.files.values():
+                total_files += 1
+                storage = self._storage(st)
+                if storage not in seen:
+                    seen.add(storage)
+                    total_bytes += st.size
+        return total_bytes, total_files
+
+    def _tree_of(self, path: Path) -> Node | None:
+        roots = {tree.path: tree for tree in self.trees}
+        for candidate in (path, *path.parents):
+            if candidate in roots:
+                return roots[candidate]
+        return None
+
+    def resolve(self, path: Path, _depth: int = 0) -> Node | None:
+        """Return the live directory node at *path*, following symlinks
+        recorded in the index (like ``realpath``).  None if it does not
+        exist or lies outside every tree.
+        """
+        tree = self._tree_of(path)
+        if tree is None or _depth > 40:
+            return None
+        node = tree
+        parts = path.relative_to(tree.path).parts
+        for i, part in enumerate(parts):
+            if part in node.dirs:
+                node = node.dirs[part]
+            elif part in node.links:
+                target = Path(os.path.normpath(node.path / node.links[part]))
+                return self.resolve(target.joinpath(*parts[i + 1:]), _depth + 1)
+            else:
+                return None
+        return node
+
+    def exists(self, path: Path) -> bool | None:
+        """Whether *path* (file, dir or link) exists; None if outside the index."""
+        if self._tree_of(path) is None:
+            return None
+        if self.resolve(path) is not None:
+            return True
+        parent = self.resolve(path.parent)
+        return parent is not None and (path.name in parent.files or path.name in parent.links)
+
+    def follow(self, path: Path) -> tuple[str, Path]:
+        """Resolve the index symlinks along *path*.
+
+        Returns ``(status, path)``: ``ok`` with the link-free path, or
+        ``missing``, ``cycle`` or ``external`` (leaves the trees).
+        """
+        for _ in range(40):
+            tree = self._tree_of(path)
+            if tree is None:
+                return "external", path
+            node = tree
+            parts = path.relative_to(tree.path).parts
+            for i, part in enumerate(parts):
+                if part in node.dirs:
+                    node = node.dirs[part]
+                elif part in node.links:
+                    target = Path(os.path.normpath(node.path / node.links[part]))
+                    path = target.joinpath(*parts[i + 1:])
+                    break
+                elif i == len(parts) - 1 and part in node.files:
+                    return "ok", path
+                else:
+                    return "missing", path
+            else:
+                return "ok", path
+        return "cycle", path
+
+    def _link_key(self, node: Node, name: str) -> str:
+        return os.path.normpath(os.path.join(node.path, node.links[name]))
+
+    def _track_link(self, node: Node, name: str, add: bool = True) -> None:
+        if self._links_to is None:
+            return
+        links = self._links_to.setdefault(self._link_key(node, name), set())
+        if add:
+            links.add((node, name))
+        else:
+            links.discard((node, name))
+
+    def inbound_links(self, node: Node) -> list[tuple[Node, str, Path]]:
+        """Symlinks outside *node* that end at it or inside it.
+
+        Returns ``(link dir, link name, resolved target)`` sorted by path.
+        Only links whose own target lies at or below *node* are found;
+        links that reach it through another symlink resolve via that one.
+        """
+        if self._links_to is None:
+            self._links_to = {}
+            for src in self.iter_nodes():
+                for name in src.links:
+                    self._track_link(src, name)
+        root = str(node.path)
+        found = []
+        for key, links in self._links_to.items():
+            if key != root and not key.startswith(root + os.sep):
+                continue
+            for src, name in links:
+                if src.path.is_relative_to(node.path):
+                    continue
+                status, resolved = self.follow(src.path / name)
+                if status == "ok" and resolved.is_relative_to(node.path):
+                    found.append((src, name, resolved))
+        return sorted(found, key=lambda link: link[0].path / link[1])
+
+    def resolve_package(self, from_dir: Path, name: str) -> Node | None:
+        """Resolve ``require(name)`` from *from_dir* like Node does.
+
+        Looks in ``<dir>/node_modules/<name>`` for *from_dir* and each of
+        its parents up to apps/, returning the real package node.
+        """
+        directory = from_dir
+        while True:
+            if directory.name != "node_modules":
+                pkg = self.resolve(directory / "node_modules" / name)
+                if pkg is not None:
+                    return pkg
+            if directory == self.apps_dir or directory.parent == directory:
+                return None
+            directory = directory.parent
+
+    @staticmethod
+    def child(nm: Node, pkg_name: str) -> Node | None:
+        """Return the live package node ``nm/<pkg_name>`` (scoped aware)."""
+        node = nm
+        for part in pkg_name.split("/"):
+            node = node.dirs.get(part)
+            if node is None:
+                return None
+        return node
+
+    # -- mutations ---------------------------------------------------------
+
+    def _storage(self, st: FileStat) -> int:
+        """Identity of the bytes behind *st*: its inode, or for a file
+        reflinked by this run the inode it was cloned from."""
+        return self._clones.get(st.ino, st.ino)
+
+    def _refcounts(self) -> Counter:
+        if self._refs is None:
+            self._refs = Counter(self._storage(st) for n in self.iter_nodes()
+                                 for st in n.files.values())
+        return self._refs
+
+    def _release(self, st: FileStat) -> int:
+        """Drop one link to *st*; returns its size if that was the last one."""
+        refs = self._refcounts()
+        storage = self._storage(st)
+        refs[storage] -= 1
+        if refs[storage] > 0:
+            return 0
+        del refs[storage]
+        return st.size
+
+    def _freed(self, node: Node) -> int:
+        """Release every file below *node*; returns the bytes that go away."""
+        return sum(self._release(st) for n in node.iter_tree() for st in n.files.values())
+
+    def _record(self, action: str, node: Node, path: Path, size: int, files: int,
+                target: Path | None = None) -> None:
+        pkg = owning_package(node)
+        self.changes.append(Change(self.phase, action, path, pkg.label if pkg else None,
+                                   size, files, target))
+
+    def _detach(self, node: Node) -> None:
+        if node.parent is not None:
+            node.parent.dirs.pop(node.path.name, None)
+        for n in node.iter_tree():
+            n.removed = True
+            if n.key:
+                self.gone[n.path] = n.label
+            for name in n.links:
+                self._track_link(n, name, add=False)
+
+    def remove(self, node: Node) -> int:
+        """Delete a directory from disk and index.
+
+        Returns bytes freed: files still hardlinked elsewhere free nothing.
+        """
+        if not self.dry_run:
+            shutil.rmtree(node.path)
+        size = self._freed(node)
+        self._record("remove", node, node.path, size, node.file_count())
+        self._detach(node)
+        return size
+
+    def replace_with_symlink(self, node: Node, target: Node) -> int:
+        """Replace *node* with a relative symlink to *target*.
+
+        Nested packages that other symlinks point into are promoted out
+        first (see :meth:`remove_package`).  Returns bytes freed.
+        """
+        self._rescue_nested(node)
+        rel_target = os.path.relpath(target.path, node.path.parent)
+        if not self.dry_run:
+            shutil.rmtree(node.path)
+            os.symlink(rel_target, node.path)
+        size = self._freed(node)
+        self._record("symlink", node, node.path, size, node.file_count(), target.path)
+        self._detach(node)
+        node.parent.links[node.path.name] = rel_target
+        self._track_link(node.parent, node.path.name)
+        return size
+
+    def relink(self, node: Node, name: str, target: Path) -> None:
+        """Point the symlink ``node/name`` at *target* (written relative)."""
+        rel_target = os.path.relpath(target, node.path)
+        if not self.dry_run:
+            (node.path / name).unlink()
+            os.symlink(rel_target, node.path / name)
+        self._record("relink", node, node.path / name, 0, 0, target)
+        self._track_link(node, name, add=False)
+        node.links[name] = rel_target
+        self._track_link(node, name)
+
+    def remove_package(self, node: Node) -> tuple[int, Path | None]:
+        """Remove a package directory unless symlinks elsewhere still use it.
+
+        If a symlink points at the package it is *promoted* instead: moved
+        to the place of the first such symlink, with the other symlinks
+        re-pointed to its new location.  Nested packages that symlinks
+        point into are promoted out before the rest is removed.  Returns
+        (bytes freed, new location or None).
+        """
+        for src, name, resolved in self.inbound_links(node):
+            if resolved == node.path:
+                return 0, self.move(node, src, name, "promote")
+        self._rescue_nested(node)
+        return self.remove(node), None
+
+    def _rescue_nested(self, node: Node) -> None:
+        """Promote directories below *node* that outside symlinks point to."""
+        while True:
+            for src, name, resolved in self.inbound_links(node):
+                target = self.resolve(resolved)
+                if target is not None and target is not node:
+                    self.move(target, src, name, "promote")
+                    break
+            else:
+                return
+
+    def move(self, node: Node, parent: Node, name: str, action: str = "move",
+             leave_link: bool = False) -> Path:
+        """Move the directory *node* to ``parent/name``, keeping links valid.
+
+        A symlink already at ``parent/name`` is replaced.  Symlinks pointing
+        at or into *node*, and relative links inside it that leave it, are
+        re-pointed; with *leave_link* a symlink to the new location is left
+        behind.  Returns the new path.
+        """
+        inbound = self.inbound_links(node)
+        old_path, new_path = node.path, parent.path / name
+        # Relative links inside the package that leave it must be rewritten
+        outward = []
+        for n in node.iter_tree():
+            for link_name, target in n.links.items():
+                resolved = Path(os.path.normpath(n.path / target))
+                if not resolved.is_relative_to(old_path):
+                    outward.append((n, link_name, resolved))
+
+        old_parent = node.parent
+        if self.dry_run:
+            self._moved.append((new_path, old_path))
+        else:
+            if name in parent.links:
+                new_path.unlink()
+            os.rename(old_path, new_path)
+            if leave_link:
+                os.symlink(os.path.relpath(new_path, old_path.parent), old_path)
+        self._record(action, node, old_path, 0, 0, new_path)
+        old_parent.dirs.pop(old_path.name, None)
+        parent.links.pop(name, None)
+        parent.dirs[name] = node
+        node.parent = parent
+        for n in node.iter_tree():
+            n.path = new_path / n.path.relative_to(old_path)
+        if leave_link:
+            old_parent.links[old_path.name] = os.path.relpath(new_path, old_path.parent)
+        self._links_to = None  # link targets below the moved tree changed
+
+        for n, link_name, resolved in outward:
+            self.relink(n, link_name, resolved)
+        for other, other_name, resolved in inbound:
+            if (other, other_name) != (parent, name):
+                self.relink(other, other_name, new_path / resolved.relative_to(old_path))
+        return new_path
+
+    def make_dir(self, parent: Node, name: str) -> Node:
+        """Return the directory ``parent/name``, creating it if needed."""
+        if name not in parent.dirs:
+            if not self.dry_run:
+                (parent.path / name).mkdir(exist_ok=True)
+            parent.dirs[name] = Node(parent.path / name, parent)
+        return parent.dirs[name]
+
+    def link_file(self, node: Node, name: str, source: Node, strategy: str) -> int:
+        """Replace ``node/name`` with a hardlink or reflink of ``source/name``.
+
+        The link is created next to the target first and renamed over it,
+        so the file never disappears for a concurrent reader.  Returns
+        bytes freed – nothing while another link still holds the old file.
+        """
+        src = source.path / name
+        dst = node.path / name
+        if self.dry_run:
+            # Model both strategies as sharing the source's inode
+            return self._relink_file(node, name, source.files[name], src)
+        tmp = node.path / f".{name}.dedup-tmp"
+        try:
+            if strategy == "hardlink":
+                os.link(src, tmp)
+            else:
+                _reflink(src, tmp)
+            os.replace(tmp, dst)
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            raise
+        if strategy == "hardlink":
+            return self._relink_file(node, name, source.files[name], src)
+        st = dst.stat()
+        new = FileStat(st.st_size, st.st_ino, st.st_mtime_ns)
+        self._clones[new.ino] = self._storage(source.files[name])
+        return self._relink_file(node, name, new, src)
+
+    def _relink_file(self, node: Node, name: str, new: FileStat, src: Path) -> int:
+        size = self._release(node.files[name])
+        self._refcounts()[self._storage(new)] += 1
+        node.files[name] = new
+        self._record("link", node, node.path / name, size, 1, src)
+        return size
+
+    def remove_link(self, node: Node, name: str) -> None:
+        """Delete a symlink from disk and index."""
+        if not self.dry_run:
+            (node.path / name).unlink()
+        self._record("remove-link", node, node.path / name, 0, 0)
+        self._track_link(node, name, add=False)
+        del node.links[name]
+
+    def remove_file(self, node: Node, name: str) -> int:
+        """Delete a regular file from disk and index.  Returns bytes freed."""
+        if not self.dry_run:
+            (node.path / name).unlink()
+        size = self._release(node.files[name])
+        self._record("remove-file", node, node.path / name, size, 1)
+        del node.files[name]
+        return size
+
+    def write_file(self, node: Node, name: str, content: str) -> None:
+        """Overwrite a regular file and record its new size.
+
+        Written to a temporary file and renamed over the old one, so a
+        file hardlinked by ``--strategy hardlink`` gets its own inode
+        instead of changing every linked copy.
+        """
+        path = node.path / name
+        old = node.files[name]
+        if self.dry_run:
+            # A rewritten file never shares an inode – give it a unique one
+            self._fake_ino -= 1
+            new = FileStat(len(content.encode()), self._fake_ino, old.mtime_ns)
+        else:
+            tmp = node.path / f".{name}.dedup-tmp"
+            tmp.write_text(content, encoding="utf-8")
+            shutil.copymode(path, tmp)
+            os.replace(tmp, path)
+            st = path.stat()
+            new = FileStat(st.st_size, st.st_ino, st.st_mtime_ns)
+        self._refcounts()[self._storage(new)] += 1
+        self._record("rewrite", node, path, self._release(old) - new.size, 1)
+        node.files[name] = new
+
+
+# ---------------------------------------------------------------------------
+# Content digests (--verify-content / --by-content)
+# ---------------------------------------------------------------------------
+
+
+class ContentHasher:
+    """Content digests for package trees.
+
+    A tree digest covers every file (relative path + content digest) and
+    every symlink (relative path + resolved target) below the package
+    directory, including its nested node_modules – that is exactly what a
+    dedup replacement throws away.
+
+    File digests are cached by ``(inode, mtime_ns, size)``, so hard-linked
+    copies are read once and unchanged files are never re-read while the
+    cache lives.
+    """
+
+    def __init__(self, jobs: int = 1, cache: dict | None = None,
+                 locate: Callable[[Path], Path] | None = None):
+        self.jobs = jobs
+        self.cache: dict[tuple[int, int, int], str] = cache if cache is not None else {}
+        # Maps an index path to the file on disk (NodeModulesIndex.disk_path)
+        self.locate = locate or (lambda path: path)
+
+    @staticmethod
+    def _cache_key(st: FileStat) -> tuple[int, int, int]:
+        return st.ino, st.mtime_ns, st.size
+
+    @staticmethod
+    def _hash_file(path: Path) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        try:
+            with open(path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    h.update(chunk)
+        except OSError:
+            # Unreadable → unique digest, never merged
+            return f"unreadable:{path}"
+        return h.hexdigest()
+
+    def fill(self, nodes: list[Node]) -> None:
+        """Hash every not-yet-cached file below *nodes* (in parallel)."""
+        todo: dict[tuple[int, int, int], Path] = {}
+        for node in nodes:
+            for n in node.iter_tree():
+                for name, st in n.files.items():
+                    key = self._cache_key(st)
+                    if key not in self.cache and key not in todo:
+                        todo[key] = self.locate(n.path / name)
+        keys = list(todo)
+        for key, digest in zip(keys, _pmap(self._hash_file, [todo[k] for k in keys], self.jobs)):
+            self.cache[key] = digest
+
+    def same_content(self, a: FileStat, b: FileStat) -> bool:
+        """True if two (already hashed) files have identical content."""
+        return self.cache[self._cache_key(a)] == self.cache[self._cache_key(b)]
+
+    def tree_digest(self, node: Node) -> str:
+        """Digest of the whole package tree (cache must be filled)."""
+        h = hashlib.blake2b(digest_size=16)
+        root = node.path
+        for n in sorted(node.iter_tree(), key=lambda d: d.path):
+            rel = n.path.relative_to(root).as_posix()
+            for name in sorted(n.files):
+                h.update(f"f {rel}/{name} {self.cache[self._cache_key(n.files[name])]}\n".encode())
+            for name in sorted(n.links):
+                target = os.path.normpath(os.path.join(n.path, n.links[name]))
+                h.update(f"l {rel}/{name} {target}\n".encode())
+        return h.hexdigest()
+
+    def digests(self, nodes: list[Node]) -> dict[Node, str]:
+        """Return {node: tree digest} for *nodes*."""
+        self.fill(nodes)
+        return {node: self.tree_digest(node) for node in nodes}
+
+
+def group_duplicates(entries: list, node_of, hasher: ContentHasher | None = None,
+                     by_content: bool = False, root: Path | None = None) -> list[list]:
+    """Group *entries* (in discovery order) into dedup groups.
+
+    *node_of* maps an entry to its package :class:`Node`.  The first entry
+    of every returned group is the canonical copy; groups are sorted by
+    the canonical copy's ``(name, version)``.  *root* only shortens the
+    paths in mismatch reports.
+
+    - default: group by ``(npm name, version)``
+    - with *hasher* (``--verify-content``): additionally split each group by
+      tree digest, so only byte-identical copies are merged.  Mismatching
+      copies are reported and merged only among themselves.
+    - with *by_content* (``--by-content``): group by tree digest alone.
+      Identical bytes imply an identical package.json, so this additionally
+      merges package dirs *without* a usable name/version (git checkouts,
+      patched copies) and, like verify, never merges differing copies.
+    """
+    by_key: dict[tuple[str, str], list] = defaultdict(list)
+    for entry in entries:
+        if node_of(entry).key:
+            by_key[node_of(entry).key].append(entry)
+
+    if hasher is None:
+        groups = list(by_key.values())
+    elif not by_content:
+        groups = []
+        candidates = [e for group in by_key.values() if len(group) > 1 for e in group]
+        digests = hasher.digests([node_of(e) for e in candidates])
+        for group in by_key.values():
+            if len(group) < 2:
+                continue
+            split: dict[str, list] = defaultdict(list)
+            for entry in group:
+                split[digests[node_of(entry)]].append(entry)
+            canonical = node_of(group[0])
+            for sub in split.values():
+                if node_of(sub[0]) is not canonical:
+                    for entry in sub:
+                        dup_path = node_of(entry).path
+                        canon_path = canonical.path
+                        if root is not None:
+                            dup_path = dup_path.relative_to(root)
+                            canon_path = canon_path.relative_to(root)
+                        print(f"  ⚠ {canonical.label}: {dup_path} differs "
+                              f"from {canon_path} – not merged with it")
+                groups.append(sub)
+    else:
+        # Cheap pre-filter: only trees with the same size + file count can match
+        by_shape: dict[tuple[int, int], list] = defaultdict(list)
+        for entry in entries:
+            node = node_of(entry)
+            by_shape[(node.size(), node.file_count())].append(entry)
+        candidates = [e for group in by_shape.values() if len(group) > 1 for e in group]
+        digests = hasher.digests([node_of(e) for e in candidates])
+        split = defaultdict(list)
+        for entry in candidates:
+            split[digests[node_of(entry)]].append(entry)
+        groups = list(split.values())
+
+    def _order(group):
+        node = node_of(group[0])
+        return node.npm_name or node.path.name, node.version or ""
+
+    return sorted((g for g in groups if len(g) > 1), key=_order)
+
+
+# ---------------------------------------------------------------------------
+# 1. Find all node_modules trees
+# ---------------------------------------------------------------------------
+
+
 def find_all_node_modules(apps_dir: Path) -> list[Path]:
     """Return all node_modules directories under apps_dir.
 
@@ -132,187 +1176,209 @@ def find_all_node_modules(apps_dir: Path) -> list[Path]:
     followed by sub-app node_modules (sorted).  This ensures that
     ``dedup()`` always picks a top-level tree as the canonical copy.
     """
-    top_level = []
-    sub_app = []
-    for nm in sorted(apps_dir.rglob("node_modules")):
-        # Only consider real directories, skip symlinks and nested nm inside nm
-        if nm.is_symlink():
-            continue
-        # Skip nested node_modules (nm/pkg/node_modules) – those are handled
-        # when we recurse into the parent nm for cleaning.
-        # We only want the "root" node_modules per app (or sub-app like billing).
-        parts = nm.parts
-        nm_count = parts.count("node_modules")
-        if nm_count == 1:
-            if _is_top_level_nm(nm, apps_dir):
-                top_level.append(nm)
-            else:
-                sub_app.append(nm)
-    # Top-level first → they become canonical in dedup()
-    return top_level + sub_app
+    return NodeModulesIndex.build(apps_dir).nm_dirs
 
 
 # ---------------------------------------------------------------------------
 # 2. Deduplication (top-level packages across apps)
 # ---------------------------------------------------------------------------
 
+# How a duplicate is merged into its canonical copy:
+#   symlink   – replace the duplicate package dir with a relative symlink
+#   hardlink  – keep the dir, hardlink every identical file (same layer only:
+#               Docker stores a hardlinked file once per layer)
+#   reflink   – keep the dir, CoW-clone every identical file (FICLONE);
+#               saves disk in volumes, not in image layers
+STRATEGIES = ("symlink", "hardlink", "reflink")
+
+
+@dataclass
+class DedupOptions:
+    """How dedup() / dedup_nested() group and merge duplicates."""
+    strategy: str = "symlink"
+    verify_content: bool = False
+    by_content: bool = False
+    hasher: ContentHasher | None = None
+    hoist: bool = False           # run hoist_compatible() after dedup_nested()
+    hoist_strict: bool = False    # … but never across a major version
+    # --incremental: packages new or changed since the last run (None → all)
+    changed: set[Node] | None = None
+
+    @property
+    def grouping_hasher(self) -> ContentHasher | None:
+        """Hasher for digest-based grouping (None → group by name + version)."""
+        if self.verify_content or self.by_content:
+            return self.hasher
+        return None
+
+    def candidates(self, entries: list, node_of) -> list:
+        """Drop *entries* whose key no changed package shares.
+
+        Only groups with a new or changed copy need merging again; all
+        others were merged by the previous run.  Digest-only grouping
+        (``--by-content``) has no key to filter on – see :meth:`affected`.
+        """
+        if self.changed is None or self.by_content:
+            return entries
+        keys = {node.key for node in self.changed}
+        return [e for e in entries if node_of(e).key in keys]
+
+    def affected(self, nodes) -> bool:
+        """True if one of *nodes* is new or changed (always without a manifest)."""
+        return self.changed is None or any(node in self.changed for node in nodes)
+
+
+def _merge_duplicate(index: NodeModulesIndex, dup: Node, canonical: Node,
+                     opts: DedupOptions) -> tuple[int, str] | None:
+    """Merge *dup* into *canonical* using ``opts.strategy``.
+
+    Returns (bytes_saved, log suffix), or None if nothing was left to
+    link.  File-level strategies only link files that exist at the same
+    relative path in both trees and have identical content; everything
+    else in *dup* stays as it is, so Node's module resolution (and
+    ``realpath``) is unchanged.
+    """
+    if opts.strategy == "symlink":
+        return index.replace_with_symlink(dup, canonical), ""
+
+    hasher = opts.hasher
+    hasher.fill([dup, canonical])
+    saved = 0
+    linked = 0
+    for node in list(dup.iter_tree()):
+        source = canonical
+        for part in node.path.relative_to(dup.path).parts:
+            source = source.dirs.get(part) if source is not None else None
+        if source is None:
+            continue
+        for name, st in list(node.files.items()):
+            src_st = source.files.get(name)
+            if (src_st is None or src_st.size != st.size or src_st.ino == st.ino
+                    or not hasher.same_content(st, src_st)):
+                continue
+            saved += index.link_file(node, name, source, opts.strategy)
+            linked += 1
+    if not linked:
+        return None
+    return saved, f" ({linked} files {opts.strategy}ed)"
 
-def iter_top_level_packages(nm_dirs: list[Path]):
-    """Yield (nm_label, npm_name, version, pkg_path) for every top-level
+
+def iter_top_level_packages(index: NodeModulesIndex, keyed_only: bool = True):
+    """Yield (nm_label, npm_name, version, pkg_node) for every top-level
     package in every node_modules directory.
 
     Uses the *npm* ``name`` field from ``package.json`` – not the directory
     name – so that npm aliases (e.g. ``wrap-ansi-cjs`` → ``wrap-ansi``)
-    are grouped correctly during deduplication.
+    are grouped correctly during deduplication.  With ``keyed_only=False``
+    packages without a usable name/version are yielded too (``None``).
     """
 
-    for nm_dir in nm_dirs:
+    for tree in index.trees:
+        nm_dir = tree.path
         # Label for display (e.g. "frappe", "frappe/billing", "iq_core")
         label = "/".join(nm_dir.parent.relative_to(nm_dir.parents[1]).parts)
 
-        for entry in sorted(nm_dir.iterdir()):
-            if entry.name.startswith(".") or entry.is_symlink():
-                continue
+        for pkg in iter_packages(tree):
+            if pkg.key or not keyed_only:
+                yield label, pkg.npm_name, pkg.version, pkg
 
-            if entry.name.startswith("@"):
-                # Scoped package (@scope/name)
-                if not entry.is_dir():
-                    continue
-                for sub in sorted(entry.iterdir()):
-                    if sub.is_symlink() or not sub.is_dir():
-                        continue
-                    npm_name, version = _read_pkg_meta(sub / "package.json")
-                    if npm_name and version:
-                        yield label, npm_name, version, sub
-            else:
-                if not entry.is_dir():
-                    continue
-                npm_name, version = _read_pkg_meta(entry / "package.json")
-                if npm_name and version:
-                    yield label, npm_name, version, entry
 
+def dedup(index: NodeModulesIndex, opts: DedupOptions | None = None) -> tuple[int, int]:
+    """Deduplicate identical packages across node_modules directories.
 
-def dedup(nm_dirs: list[Path]) -> tuple[int, int]:
-    """Deduplicate identical packages across node_modules directories."""
+    See :func:`group_duplicates` for how ``--verify-content`` /
+    ``--by-content`` change which copies count as identical and
+    :func:`_merge_duplicate` for the merge strategies.
+    """
+    opts = opts or DedupOptions()
 
-    groups: dict[tuple[str, str], list[tuple[str, Path]]] = defaultdict(list)
-    for label, pkg_name, version, pkg_path in iter_top_level_packages(nm_dirs):
-        groups[(pkg_name, version)].append((label, pkg_path))
+    entries = [(label, pkg) for label, _, _, pkg in iter_top_level_packages(index, not opts.by_content)]
+    entries = opts.candidates(entries, lambda e: e[1])
+    groups = group_duplicates(entries, lambda e: e[1], opts.grouping_hasher,
+                              opts.by_content, index.apps_dir)
+    groups = [g for g in groups if opts.affected(pkg for _, pkg in g)]
 
     deduped_count = 0
     saved_bytes = 0
 
-    for (pkg_name, version), entries in sorted(groups.items()):
-        if len(entries) < 2:
-            continue
-
-        canonical_label, canonical_path = entries[0]
-
-        for dup_label, dup_path in entries[1:]:
-            pkg_size = _dir_size(dup_path)
-            shutil.rmtree(dup_path)
-
-            rel_target = os.path.relpath(canonical_path, dup_path.parent)
-            os.symlink(rel_target, dup_path)
+    for group in groups:
+        canonical_label, canonical = group[0]
 
+        for dup_label, dup in group[1:]:
+            merged = _merge_duplicate(index, dup, canonical, opts)
+            if merged is None:
+                continue
+            saved, note = merged
+            saved_bytes += saved
             deduped_count += 1
-            saved_bytes += pkg_size
-            print(f"  {pkg_name}@{version}: {dup_label} → {canonical_label}")
+            print(f"  {dup.label}: {dup_label} → {canonical_label}"
+                  f"{_content_note(dup, canonical)}{note}")
 
     return deduped_count, saved_bytes
 
 
+def _content_note(dup: Node, canonical: Node) -> str:
+    """Log suffix for --by-content merges across different keys."""
+    if dup.label == canonical.label:
+        return ""
+    return f" (identical to {canonical.label})"
+
+
 # ---------------------------------------------------------------------------
 # 3. Nested dedup: replace nested packages with symlinks to top-level
 # ---------------------------------------------------------------------------
 
 
-def _collect_all_packages(nm_dirs: list[Path], apps_dir: Path) -> dict[tuple[str, str], list[Path]]:
-    """Collect every package instance (top-level AND nested) across all trees.
+def _iter_all_packages(index: NodeModulesIndex, keyed_only: bool = True):
+    """Yield every package node (top-level AND nested) across all trees.
 
-    Returns {(npm_name, version): [path, ...]} where the first entry is the
-    canonical copy.
+    Only packages with a usable ``(name, version)`` unless *keyed_only* is
+    False.
 
     **Ordering**: packages from top-level app node_modules (``apps/<app>/
-    node_modules``) appear first in each list, so they are always preferred
-    as canonical copies over sub-app trees (like ``frappe/billing/node_modules``).
+    node_modules``) come first, so they are always preferred as canonical
+    copies over sub-app trees (like ``frappe/billing/node_modules``).
     This prevents broken symlinks in devcontainer volumes where sub-app
     directories may not exist.
     """
-    groups: dict[tuple[str, str], list[Path]] = defaultdict(list)
 
-    def _scan_dir(nm_dir: Path):
-        """Recursively scan a node_modules directory for packages."""
-        if not nm_dir.is_dir() or nm_dir.is_symlink():
+    def _scan_nested(pkg: Node):
+        """Recursively yield packages below pkg/node_modules."""
+        nested = pkg.dirs.get("node_modules")
+        if nested is None:
             return
-        for entry in sorted(nm_dir.iterdir()):
-            if entry.is_symlink() or not entry.is_dir():
-                continue
-            if entry.name.startswith("."):
-                continue
+        for sub in iter_packages(nested):
+            if sub.key or not keyed_only:
+                yield sub
+            yield from _scan_nested(sub)
+
+    # index.trees is already ordered: top-level first, sub-app second.
+    # Phase 1: top-level packages from ALL trees (they get first slots)
+    for tree in index.trees:
+        for pkg in iter_packages(tree):
+            if pkg.key or not keyed_only:
+                yield pkg
+
+    # Phase 2: nested packages (after top-level → never canonical
+    # unless no top-level copy exists)
+    for tree in index.trees:
+        for pkg in iter_packages(tree):
+            yield from _scan_nested(pkg)
 
-            if entry.name.startswith("@"):
-                # Scoped package (@scope/name)
-                for sub in sorted(entry.iterdir()):
-                    if sub.is_symlink() or not sub.is_dir():
-                        continue
-                    npm_name, version = _read_pkg_meta(sub / "package.json")
-                    if npm_name and version:
-                        groups[(npm_name, version)].append(sub)
-                    # Recurse into nested node_modules
-                    nested = sub / "node_modules"
-                    if nested.is_dir() and not nested.is_symlink():
-                        _scan_dir(nested)
-            else:
-                npm_name, version = _read_pkg_meta(entry / "package.json")
-                if npm_name and version:
-                    groups[(npm_name, version)].append(entry)
-                # Recurse into nested node_modules
-                nested = entry / "node_modules"
-                if nested.is_dir() and not nested.is_symlink():
-                    _scan_dir(nested)
-
-    # nm_dirs is already ordered: top-level first, sub-app second
-    # (guaranteed by find_all_node_modules).
-    # Phase 1: collect top-level packages from ALL nm_dirs (they get first slots)
-    for nm_dir in nm_dirs:
-        for entry in sorted(nm_dir.iterdir()):
-            if entry.is_symlink() or not entry.is_dir() or entry.name.startswith("."):
-                continue
-            if entry.name.startswith("@"):
-                for sub in sorted(entry.iterdir()):
-                    if sub.is_symlink() or not sub.is_dir():
-                        continue
-                    npm_name, version = _read_pkg_meta(sub / "package.json")
-                    if npm_name and version:
-                        groups[(npm_name, version)].append(sub)
-            else:
-                npm_name, version = _read_pkg_meta(entry / "package.json")
-                if npm_name and version:
-                    groups[(npm_name, version)].append(entry)
 
-    # Phase 2: collect nested packages (appended after top-level → never canonical
-    # unless no top-level copy exists)
-    for nm_dir in nm_dirs:
-        for entry in sorted(nm_dir.iterdir()):
-            if entry.is_symlink() or not entry.is_dir() or entry.name.startswith("."):
-                continue
-            if entry.name.startswith("@"):
-                for sub in sorted(entry.iterdir()):
-                    if sub.is_symlink() or not sub.is_dir():
-                        continue
-                    nested = sub / "node_modules"
-                    if nested.is_dir() and not nested.is_symlink():
-                        _scan_dir(nested)
-            else:
-                nested = entry / "node_modules"
-                if nested.is_dir() and not nested.is_symlink():
-                    _scan_dir(nested)
+def _collect_all_packages(index: NodeModulesIndex) -> dict[tuple[str, str], list[Node]]:
+    """Collect every package instance (top-level AND nested) across all trees.
 
+    Returns {(npm_name, version): [node, ...]} where the first entry is the
+    canonical copy (see :func:`_iter_all_packages` for the ordering).
+    """
+    groups: dict[tuple[str, str], list[Node]] = defaultdict(list)
+    for pkg in _iter_all_packages(index):
+        groups[pkg.key].append(pkg)
     return groups
 
 
-def dedup_nested(nm_dirs: list[Path], apps_dir: Path) -> tuple[int, int]:
+def dedup_nested(index: NodeModulesIndex, opts: DedupOptions | None = None) -> tuple[int, int]:
     """Replace duplicate packages with symlinks to a single canonical copy.
 
     Handles both:
@@ -323,71 +1389,203 @@ def dedup_nested(nm_dirs: list[Path], apps_dir: Path) -> tuple[int, int]:
       socket.io-adapter, engine.io, engine.io-client)
 
     The first encountered copy (preferring top-level app node_modules)
-    becomes canonical; all others are replaced with relative symlinks.
+    becomes canonical; all others are replaced with relative symlinks
+    (or file-level links, see *opts* / :func:`dedup`).
 
     Returns (replaced_count, bytes_saved).
     """
-    groups = _collect_all_packages(nm_dirs, apps_dir)
+    opts = opts or DedupOptions()
+    apps_dir = index.apps_dir
+    if opts.grouping_hasher is None:
+        groups = [nodes for _, nodes in sorted(_collect_all_packages(index).items())]
+    else:
+        entries = opts.candidates(list(_iter_all_packages(index, not opts.by_content)),
+                                  lambda n: n)
+        groups = group_duplicates(entries, lambda n: n, opts.grouping_hasher,
+                                  opts.by_content, apps_dir)
+    groups = [nodes for nodes in groups if opts.affected(nodes)]
 
     replaced = 0
     saved_bytes = 0
 
-    for (npm_name, version), paths in sorted(groups.items()):
-        # Filter to real (non-symlink) paths that still exist
-        real = [p for p in paths if p.exists() and not p.is_symlink()]
+    for nodes in groups:
+        # Skip copies that an earlier replacement already removed
+        real = [n for n in nodes if not n.removed]
         if len(real) < 2:
             continue
 
         canonical = real[0]
 
         for dup in real[1:]:
-            pkg_size = _dir_size(dup)
-            shutil.rmtree(dup)
-            rel = os.path.relpath(canonical, dup.parent)
-            os.symlink(rel, dup)
+            if dup.removed:
+                continue
+            merged = _merge_duplicate(index, dup, canonical, opts)
+            if merged is None:
+                continue
+            saved, note = merged
+            saved_bytes += saved
             replaced += 1
-            saved_bytes += pkg_size
 
             try:
                 # Pretty-print relative to apps dir
-                apps_dir = nm_dirs[0].parents[1]
-                dup_rel = dup.relative_to(apps_dir)
-                canon_rel = canonical.relative_to(apps_dir)
-                print(f"  {npm_name}@{version}: {dup_rel} → {canon_rel}")
+                dup_rel = dup.path.relative_to(apps_dir)
+                canon_rel = canonical.path.relative_to(apps_dir)
+                print(f"  {dup.label}: {dup_rel} → {canon_rel}"
+                      f"{_content_note(dup, canonical)}{note}")
             except ValueError:
-                print(f"  {npm_name}@{version}: symlinked duplicate")
+                print(f"  {dup.label}: symlinked duplicate")
 
     return replaced, saved_bytes
 
 
 # ---------------------------------------------------------------------------
-# 4. Cleanup: remove test dirs, source maps, docs, CI configs (renumbered)
+# 3b. Range-aware hoisting: collapse compatible versions (--hoist)
 # ---------------------------------------------------------------------------
 
+# package.json fields whose ranges constrain what a package may resolve to
+_HOIST_DEP_FIELDS = ("dependencies", "optionalDependencies", "peerDependencies")
 
-def _should_remove_file(name: str) -> bool:
-    """Return True if a file should be removed based on name/extension."""
-    if name.suffix in REMOVE_EXTENSIONS:
-        return True
-    name_str = name.name
-    for pattern in REMOVE_FILE_GLOBS:
-        if "*" in pattern:
-            # Simple glob: *.ext or prefix*
-            if pattern.startswith("*"):
-                if name_str.endswith(pattern[1:]) or (pattern[1] == "." and name.suffix == pattern[1:]):
-                    return True
-            elif pattern.endswith("*"):
-                if name_str.startswith(pattern[:-1]):
-                    return True
-        else:
-            if name_str == pattern:
-                return True
-    return False
+
+def _read_dependencies(pkg_json: Path, fields) -> dict[str, str]:
+    """Merged ``{name: range}`` of *fields* in a package.json ({} on error)."""
+    try:
+        data = json.loads(pkg_json.read_text())
+    except (OSError, json.JSONDecodeError):
+        return {}
+    deps = {}
+    if isinstance(data, dict):
+        for field in fields:
+            if isinstance(data.get(field), dict):
+                deps.update(data[field])
+    return deps
+
+
+def _collect_dependents(index: NodeModulesIndex) -> dict[Node, list[tuple[str, str]]]:
+    """Map every package node to the ``(dependent, range)`` pairs resolving to it.
+
+    Dependents are the apps (their package.json, incl. devDependencies –
+    installed at top level) and every package (runtime dependency fields).
+    Resolution follows Node's lookup, so a range is attributed to the copy
+    the dependent actually loads.
+    """
+    sources = []   # (label, requiring dir, package.json, fields)
+    for tree in index.trees:
+        app_dir = tree.path.parent
+        sources.append((index.rel(app_dir), app_dir, app_dir / "package.json",
+                        (*_HOIST_DEP_FIELDS, "devDependencies")))
+    for pkg in _iter_all_packages(index):
+        sources.append((pkg.label, pkg.path, pkg.path / "package.json", _HOIST_DEP_FIELDS))
+
+    deps = _pmap(lambda src: _read_dependencies(index.disk_path(src[2]), src[3]),
+                 sources, index.jobs)
+    dependents: dict[Node, list[tuple[str, str]]] = defaultdict(list)
+    for (label, from_dir, _, _), declared in zip(sources, deps):
+        for name, spec in declared.items():
+            target = index.resolve_package(from_dir, name)
+            if target is not None:
+                dependents[target].append((label, spec))
+    return dependents
+
+
+def _tree_root(node: Node) -> Node:
+    while node.parent is not None:
+        node = node.parent
+    return node
+
+
+def hoist_compatible(index: NodeModulesIndex, strict: bool = False,
+                     changed: set[Node] | None = None) -> tuple[int, int]:
+    """Replace older copies of a package by a newer copy every dependent accepts.
+
+    For each npm name with several versions left after :func:`dedup_nested`,
+    an older copy is replaced with a symlink to the highest newer copy
+    that satisfies the declared range of *every* package resolving to it.
+    Copies are left alone when a dependent's range is not plain semver
+    (tags, URLs, ``npm:`` aliases), when nothing is known to depend on
+    them, or when another symlink points into them.  Copies in sub-app
+    trees are only used as targets from within the same tree (see
+    :func:`_iter_all_packages`).  With *strict*, substitutions that cross
+    a major version are refused and reported.  With *changed* (see
+    :class:`DedupOptions`) only names with a new or changed copy are
+    considered.
+
+    Returns (replaced_count, bytes_saved).
+    """
+    dependents = _collect_dependents(index)
+    apps_dir = index.apps_dir
+
+    # Nodes with an inbound symlink somewhere below them must stay
+    protected: set[Node] = set()
+
+    def protect_ancestors(node: Node) -> None:
+        node = node.parent
+        while node is not None and node not in protected:
+            protected.add(node)
+            node = node.parent
+
+    for node in list(index.iter_nodes()):
+        for target in node.links.values():
+            resolved = index.resolve(Path(os.path.normpath(node.path / target)))
+            if resolved is not None:
+                protect_ancestors(resolved)
+
+    copies: dict[str, dict[npm_semver.Version, Node]] = defaultdict(dict)
+    for pkg in _iter_all_packages(index):
+        version = npm_semver.parse_version(pkg.version)
+        # Skip aliased directories (dir name ≠ npm name)
+        if version is not None and pkg.path.as_posix().endswith("/" + pkg.npm_name):
+            copies[pkg.npm_name].setdefault(version, pkg)
+
+    replaced = 0
+    saved_bytes = 0
+    for name in sorted(copies):
+        if changed is not None and not any(node in changed for node in copies[name].values()):
+            continue
+        versions = sorted(copies[name], key=lambda v: v.key)
+        for i, version in enumerate(versions[:-1]):
+            old = copies[name][version]
+            users = dependents.get(old)
+            if old.removed or not users or old in protected:
+                continue
+            ranges = [npm_semver.parse_range(spec) for _, spec in users]
+            if any(r is None for r in ranges):
+                continue
+            for candidate in reversed(versions[i + 1:]):
+                new = copies[name][candidate]
+                if new.removed or new.path.is_relative_to(old.path):
+                    continue
+                root = _tree_root(new)
+                if root is not _tree_root(old) and not _is_top_level_nm(root.path, apps_dir):
+                    continue
+                if not all(npm_semver.satisfies(candidate, r) for r in ranges):
+                    continue
+                why = ", ".join(f"{spec} from {label}" for label, spec in users)
+                if strict and candidate.major != version.major:
+                    print(f"  ✗ {name}: {index.rel(old.path)} {version} → {candidate} "
+                          f"crosses a major version ({why})")
+                    continue
+                saved_bytes += index.replace_with_symlink(old, new)
+                replaced += 1
+                dependents[new].extend(users)
+                protect_ancestors(new)
+                print(f"  {name}: {index.rel(old.path)} {version} → "
+                      f"{index.rel(new.path)} {candidate} ({why})")
+                break
+
+    return replaced, saved_bytes
+
+
+# ---------------------------------------------------------------------------
+# 4. Cleanup: remove test dirs, source maps, docs, CI configs (renumbered)
+# ---------------------------------------------------------------------------
 
 
-def clean(nm_dirs: list[Path]) -> tuple[int, int, int, int]:
+def clean(index: NodeModulesIndex) -> tuple[int, int, int, int]:
     """Remove unnecessary files and directories from all node_modules trees.
 
+    Works from the cleanup-rule matches recorded while indexing; entries
+    inside trees that an earlier phase already removed are skipped.
+
     Returns (dirs_removed, files_removed, dirs_bytes, files_bytes).
     """
     dirs_removed = 0
@@ -395,48 +1593,25 @@ def clean(nm_dirs: list[Path]) -> tuple[int, int, int, int]:
     dirs_bytes = 0
     files_bytes = 0
 
-    for nm_dir in nm_dirs:
-        # Walk ALL contents including nested node_modules
-        for root, dirs, files in os.walk(nm_dir, topdown=True):
-            root_path = Path(root)
-
-            # Skip symlinked directories
-            if root_path.is_symlink():
-                dirs.clear()
-                continue
-
-            # Remove matching directories (prune from walk)
-            remove_these = []
-            for d in dirs:
-                if d in REMOVE_DIRS:
-                    dir_path = root_path / d
-                    if dir_path.is_symlink():
-                        continue
-                    try:
-                        size = _dir_size(dir_path)
-                        shutil.rmtree(dir_path)
-                        dirs_removed += 1
-                        dirs_bytes += size
-                    except OSError:
-                        pass
-                    remove_these.append(d)
-
-            for d in remove_these:
-                dirs.remove(d)
+    # Outermost first (sorted by depth at build time) → nested matches
+    # inside an already-removed directory are skipped, not double-counted.
+    for node in index.clean_dirs:
+        if node.removed:
+            continue
+        try:
+            dirs_bytes += index.remove(node)
+            dirs_removed += 1
+        except OSError:
+            pass
 
-            # Remove matching files
-            for f in files:
-                file_path = root_path / f
-                if file_path.is_symlink():
-                    continue
-                if _should_remove_file(file_path):
-                    try:
-                        size = file_path.stat().st_size
-                        file_path.unlink()
-                        files_removed += 1
-                        files_bytes += size
-                    except OSError:
-                        pass
+    for node, name in index.clean_files:
+        if node.removed or name not in node.files:
+            continue
+        try:
+            files_bytes += index.remove_file(node, name)
+            files_removed += 1
+        except OSError:
+            pass
 
     return dirs_removed, files_removed, dirs_bytes, files_bytes
 
@@ -446,21 +1621,52 @@ def clean(nm_dirs: list[Path]) -> tuple[int, int, int, int]:
 # ---------------------------------------------------------------------------
 
 
-def prune_dev_deps(nm_dirs: list[Path]) -> tuple[int, int]:
+def _remove_top_level(index: NodeModulesIndex, targets: list[tuple[Node, str]]):
+    """Remove the top-level packages *targets* (``(tree, package name)``) together.
+
+    Dedup symlinks at any of these places are dropped first, so a copy
+    is kept only for the links that remain – and promoted once, straight
+    to its final place (see :meth:`NodeModulesIndex.remove_package`).
+    Yields ``(tree, package name, bytes freed, promoted path or None)``
+    per package directory.
+    """
+    dirs = []
+    for tree, pkg_name in targets:
+        scope, _, leaf = pkg_name.rpartition("/")
+        parent = index.child(tree, scope) if scope else tree
+        if parent is None:
+            continue
+        if leaf in parent.links:
+            try:
+                index.remove_link(parent, leaf)
+            except OSError:
+                pass
+        elif leaf in parent.dirs:
+            dirs.append((tree, pkg_name, parent.dirs[leaf]))
+
+    for tree, pkg_name, pkg in dirs:
+        try:
+            size, promoted = index.remove_package(pkg)
+        except OSError:
+            continue
+        yield tree, pkg_name, size, promoted
+
+
+def prune_dev_deps(index: NodeModulesIndex) -> tuple[int, int]:
     """Remove devDependencies from each node_modules tree.
 
     Reads each app's package.json, finds packages listed ONLY in
     devDependencies (not also in dependencies), and removes them.
+    Copies that dedup symlinks of other apps still point to are promoted,
+    not removed, and not counted (see :func:`_remove_top_level`).
     In the dev image this is safe because init_site.sh re-runs
     yarn install which restores them in the mounted volume.
 
     Returns (packages_removed, bytes_saved).
     """
-    removed_count = 0
-    saved_bytes = 0
-
-    for nm_dir in nm_dirs:
-        pkg_json = nm_dir.parent / "package.json"
+    targets = []
+    for tree in index.trees:
+        pkg_json = tree.path.parent / "package.json"
         if not pkg_json.is_file():
             continue
 
@@ -473,26 +1679,18 @@ def prune_dev_deps(nm_dirs: list[Path]) -> tuple[int, int]:
         prod_deps = set(data.get("dependencies", {}).keys())
 
         # Only remove packages that are exclusively dev dependencies
-        prune_pkgs = dev_deps - prod_deps
-        if not prune_pkgs:
-            continue
-
-        label = nm_dir.parent.name
-
-        for pkg_name in sorted(prune_pkgs):
-            # Handle scoped packages (@scope/name)
-            pkg_path = nm_dir / pkg_name
-            if not pkg_path.exists() or pkg_path.is_symlink():
-                continue
+        targets.extend((tree, pkg_name) for pkg_name in sorted(dev_deps - prod_deps))
 
-            try:
-                pkg_size = _dir_size(pkg_path)
-                shutil.rmtree(pkg_path)
-                removed_count += 1
-                saved_bytes += pkg_size
-                print(f"  {label}: {pkg_name} ({pkg_size / 1024:.0f} KB)")
-            except OSError:
-                pass
+    removed_count = 0
+    saved_bytes = 0
+    for tree, pkg_name, pkg_size, promoted in _remove_top_level(index, targets):
+        label = tree.path.parent.name
+        if promoted is not None:
+            print(f"  {label}: {pkg_name} kept{_promoted_note(index, promoted)}")
+            continue
+        removed_count += 1
+        saved_bytes += pkg_size
+        print(f"  {label}: {pkg_name} ({pkg_size / 1024:.0f} KB)")
 
     return removed_count, saved_bytes
 
@@ -535,8 +1733,47 @@ def _is_root_package_json(pj: Path) -> bool:
     return False
 
 
-def strip_sbom_from_build_artifacts(nm_dirs: list[Path]) -> int:
-    """Remove name/version/… from non-root package.json inside node_modules.
+def _json_layout(raw: bytes) -> dict:
+    """``json.dumps`` arguments that reproduce *raw*'s formatting."""
+    text = raw.strip()
+    if b"\n" not in text:
+        return {"separators": (",", ":")} if b'":"' in text or b'","' in text else {}
+    match = re.search(rb'\n([ \t]+)"', text)
+    indent = match.group(1).decode() if match else 2
+    return {"indent": indent}
+
+
+def _stripped_package_json(path: Path) -> str | None:
+    """Return *path* without SBOM fields, or None if there is nothing to strip.
+
+    A byte scan for ``"name"`` rejects most files (including every file a
+    previous run already stripped) without parsing them.  The rewrite keeps
+    the file's indentation, key order and trailing newline.
+    """
+    try:
+        raw = path.read_bytes()
+    except OSError:
+        return None
+    if b'"name"' not in raw:
+        return None
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return None
+
+    # Only strip if it actually has SBOM-relevant fields
+    if not isinstance(data, dict) or "name" not in data:
+        return None
+
+    # Remove SBOM fields, keep everything else (type, main, module, …)
+    cleaned = {k: v for k, v in data.items() if k not in SBOM_FIELDS}
+    newline = "\n" if raw.endswith(b"\n") else ""
+    return json.dumps(cleaned, ensure_ascii=False, **_json_layout(raw)) + newline
+
+
+def strip_sbom_from_build_artifacts(index: NodeModulesIndex,
+                                    checked: dict[str, FileStat] | None = None) -> int:
+    """Remove name/description/… from non-root package.json inside node_modules.
 
     These files exist in ``build/``, ``dist/``, ``esm/``, ``cjs/`` etc.
     sub-directories and are used by Node.js only for the ``"type"`` field
@@ -544,31 +1781,37 @@ def strip_sbom_from_build_artifacts(nm_dirs: list[Path]) -> int:
     ``name`` + ``version`` as an independent package, creating phantom
     duplicates in the SBOM.
 
+    Files are read and parsed on ``index.jobs`` threads and written back
+    atomically (see :meth:`NodeModulesIndex.write_file`), so an interrupted
+    run can simply be repeated; already stripped files are skipped by a
+    byte scan.  *checked* maps files a previous run already left clean
+    (relative path → stat); those are not even read while unchanged.
+
     Returns the number of files stripped.
     """
-    stripped = 0
-
-    for nm_dir in nm_dirs:
-        for pj in nm_dir.rglob("package.json"):
-            if pj.is_symlink():
-                continue
-            if _is_root_package_json(pj):
-                continue
-
-            try:
-                data = json.loads(pj.read_text())
-            except (json.JSONDecodeError, OSError):
-                continue
-
-            # Only strip if it actually has SBOM-relevant fields
-            if "name" not in data:
-                continue
-
-            # Remove SBOM fields, keep everything else (type, main, module, …)
-            cleaned = {k: v for k, v in data.items() if k not in SBOM_FIELDS}
+    candidates = []
+    for node in index.iter_nodes():
+        st = node.files.get("package.json")
+        if st is None:
+            continue
+        pj = node.path / "package.json"
+        if _is_root_package_json(pj):
+            continue
+        if checked and checked.get(index.rel(pj)) == st:
+            continue
+        candidates.append(node)
 
-            pj.write_text(json.dumps(cleaned, indent=2) + "\n")
-            stripped += 1
+    contents = _pmap(_stripped_package_json,
+                     [index.disk_path(n.path / "package.json") for n in candidates], index.jobs)
+    stripped = 0
+    for node, content in zip(candidates, contents):
+        if content is None:
+            continue
+        try:
+            index.write_file(node, "package.json", content)
+        except OSError:
+            continue
+        stripped += 1
 
     return stripped
 
@@ -613,92 +1856,877 @@ BUILD_ONLY_PACKAGES = {
 }
 
 
-def remove_build_only(nm_dirs: list[Path]) -> tuple[int, int]:
+def remove_build_only(index: NodeModulesIndex) -> tuple[int, int]:
     """Remove packages that are only needed during `bench build`.
 
-    Only removes from top-level ``node_modules/<pkg>`` directories.
-    Returns (removed_count, bytes_saved).
+    Only removes from top-level ``node_modules/<pkg>`` directories; a
+    copy that nested dedup symlinks still use is promoted to the first of
+    them instead and not counted.  Returns (removed_count, bytes_saved).
     """
+    targets = [(tree, pkg_name) for tree in index.trees
+               for pkg_name in sorted(BUILD_ONLY_PACKAGES)]
     removed = 0
     saved_bytes = 0
+    for tree, pkg_name, size, promoted in _remove_top_level(index, targets):
+        label = tree.path.parent.name
+        if promoted is not None:
+            print(f"  {label}/{pkg_name} kept{_promoted_note(index, promoted)}")
+            continue
+        removed += 1
+        saved_bytes += size
+        print(f"  {label}/{pkg_name} ({size / 1024:.0f} KB)")
+
+    return removed, saved_bytes
+
 
-    for nm_dir in nm_dirs:
-        for pkg_name in sorted(BUILD_ONLY_PACKAGES):
-            pkg_path = nm_dir / pkg_name
-            if not pkg_path.exists() or pkg_path.is_symlink():
+# ---------------------------------------------------------------------------
+# 8. Prune packages the runtime cannot reach (--prune-unreachable)
+# ---------------------------------------------------------------------------
+
+# Node entry points the release image actually runs, relative to apps/.
+# Directories are scanned for *.js recursively (outside node_modules).
+# Extend via [tool.ops.overrides.node-modules-runtime] in pyproject.toml:
+#
+#   [tool.ops.overrides.node-modules-runtime]
+#   entry-points = ["myapp/realtime/server.js"]
+#   keep = ["some-package"]        # always kept (plus its dependencies)
+DEFAULT_ENTRY_POINTS = ("frappe/socketio.js", "frappe/realtime")
+RUNTIME_SECTION = ("tool", "ops", "overrides", "node-modules-runtime")
+
+# Core modules win over packages of the same name in require()
+NODE_BUILTINS = frozenset({
+    "assert", "async_hooks", "buffer", "child_process", "cluster", "console",
+    "constants", "crypto", "dgram", "diagnostics_channel", "dns", "domain",
+    "events", "fs", "http", "http2", "https", "inspector", "module", "net",
+    "os", "path", "perf_hooks", "process", "punycode", "querystring",
+    "readline", "repl", "stream", "string_decoder", "sys", "timers", "tls",
+    "trace_events", "tty", "url", "util", "v8", "vm", "wasi",
+    "worker_threads", "zlib",
+})
+
+_IMPORT_RE = re.compile(
+    r"""(?:\brequire\s*\(\s*|\bimport\s*\(\s*|\bfrom\s+|\bimport\s+)["']([^"'\n]+)["']""")
+_SOURCE_SUFFIXES = (".js", ".cjs", ".mjs")
+# package.json fields whose packages are loaded at runtime
+_RUNTIME_DEP_FIELDS = ("dependencies", "optionalDependencies", "peerDependencies")
+
+
+def _bare_package_name(spec: str) -> str | None:
+    """Package name of a bare ``require()`` specifier (None for relative/core)."""
+    if spec.startswith((".", "/", "node:")):
+        return None
+    parts = spec.split("/")
+    name = "/".join(parts[:2]) if spec.startswith("@") else parts[0]
+    if name.split("/")[0] in NODE_BUILTINS:
+        return None
+    return name
+
+
+def _resolve_source(base: Path) -> Path | None:
+    """Resolve a relative require() target to a file (``x``, ``x.js``, ``x/index.js``)."""
+    for candidate in (base, *(base.with_name(base.name + s) for s in _SOURCE_SUFFIXES),
+                      base / "index.js"):
+        if candidate.is_file():
+            return candidate
+    return None
+
+
+def scan_entry_points(apps_dir: Path, entries) -> list[tuple[str, Path, str]]:
+    """Find the packages the entry-point sources require.
+
+    Follows relative requires between the apps' own sources (never into
+    node_modules).  Returns ``(package name, requiring dir, reason)``.
+    """
+    queue = []
+    for entry in entries:
+        path = apps_dir / entry
+        if path.is_dir():
+            queue += sorted(p for p in path.rglob("*") if p.suffix in _SOURCE_SUFFIXES
+                            and "node_modules" not in p.relative_to(apps_dir).parts)
+        elif path.is_file():
+            queue.append(path)
+        else:
+            print(f"  ⚠ entry point {entry} not found")
+
+    seen: set[Path] = set()
+    seeds = []
+    while queue:
+        source = queue.pop(0)
+        if source in seen:
+            continue
+        seen.add(source)
+        try:
+            text = source.read_text(errors="replace")
+        except OSError:
+            continue
+        rel_source = source.relative_to(apps_dir).as_posix()
+        for spec in _IMPORT_RE.findall(text):
+            if spec.startswith("."):
+                target = _resolve_source(source.parent / spec)
+                if target is not None and "node_modules" not in target.parts:
+                    queue.append(target)
                 continue
-            try:
-                size = _dir_size(pkg_path)
-                shutil.rmtree(pkg_path)
-                removed += 1
-                saved_bytes += size
-                label = nm_dir.parent.name
-                print(f"  {label}/{pkg_name} ({size / 1024:.0f} KB)")
-            except OSError:
-                pass
+            name = _bare_package_name(spec)
+            if name:
+                seeds.append((name, source.parent, f"required by {rel_source}"))
+    return seeds
+
+
+def _package_entry_file(data: dict) -> str:
+    """The file ``require(<package>)`` loads: ``exports["."]``, ``main`` or index.js."""
+    target = data.get("exports")
+    if isinstance(target, dict):
+        target = target.get(".", target if not any(k.startswith(".") for k in target) else None)
+    # Conditional exports: prefer what Node's require() picks
+    while isinstance(target, dict):
+        target = next((target[c] for c in ("node", "require", "default") if c in target), None)
+    if isinstance(target, list):
+        target = next((t for t in target if isinstance(t, str)), None)
+    if not isinstance(target, str):
+        target = data.get("main") if isinstance(data.get("main"), str) else "index.js"
+    return target
+
+
+def find_reachable(index: NodeModulesIndex, seeds) -> dict[Node, str]:
+    """Walk the runtime dependency graph from *seeds*.
+
+    Returns ``{real package node: why it is kept}``.  Dependencies are
+    resolved from the package's real location (Node resolves symlinks),
+    so a dedup'd copy keeps its canonical target alive.
+    """
+    kept: dict[Node, str] = {}
+    queue = []
+    for name, from_dir, reason in seeds:
+        pkg = index.resolve_package(from_dir, name)
+        if pkg is None:
+            print(f"  ⚠ {name} ({reason}) not found in node_modules")
+        elif pkg not in kept:
+            kept[pkg] = reason
+            queue.append(pkg)
+
+    while queue:
+        pkg = queue.pop(0)
+        try:
+            data = json.loads(index.disk_path(pkg.path / "package.json").read_text())
+        except (OSError, json.JSONDecodeError):
+            continue
+        if not isinstance(data, dict):
+            continue
+        entry_file = _package_entry_file(data)
+        entry = Path(os.path.normpath(pkg.path / entry_file))
+        if not any(index.exists(p) for p in (entry, entry.with_name(entry.name + ".js"))):
+            print(f"  ⚠ {pkg.label}: entry file {entry_file} is missing")
+        for field in _RUNTIME_DEP_FIELDS:
+            deps = data.get(field)
+            if not isinstance(deps, dict):
+                continue
+            for dep in sorted(deps):
+                child = index.resolve_package(pkg.path, dep)
+                if child is not None and child not in kept:
+                    kept[child] = f"{field} of {pkg.label}"
+                    queue.append(child)
+    return kept
+
+
+def prune_unreachable(index: NodeModulesIndex, entries=DEFAULT_ENTRY_POINTS,
+                      keep=()) -> tuple[int, int]:
+    """Remove every package the runtime entry points cannot reach.
+
+    Starts at *entries* (plus the *keep* packages, resolved from each app
+    root), follows ``dependencies`` / ``optionalDependencies`` /
+    ``peerDependencies`` transitively and removes all other packages.
+    Packages that contain a kept package (dedup canonical copies can be
+    nested) are left in place.  Symlinks left dangling are removed too.
+
+    Prints why each package was kept.  Returns (removed_count, bytes_saved).
+    """
+    seeds = scan_entry_points(index.apps_dir, entries)
+    for tree in index.trees:
+        seeds += [(name, tree.path.parent, "keep list") for name in keep]
+    kept = find_reachable(index, seeds)
+
+    for pkg in sorted(kept, key=lambda n: n.path):
+        print(f"  keep {pkg.label} ({index.rel(pkg.path)}): {kept[pkg]}")
+
+    # Ancestors of kept packages must stay, whatever their own status
+    protected = set()
+    for pkg in kept:
+        node = pkg.parent
+        while node is not None and node not in protected:
+            protected.add(node)
+            node = node.parent
+
+    removed = 0
+    saved_bytes = 0
+    for pkg in list(_iter_all_packages(index, keyed_only=False)):
+        if pkg.removed or pkg in kept or pkg in protected or "package.json" not in pkg.files:
+            continue
+        try:
+            size = index.remove(pkg)
+            removed += 1
+            saved_bytes += size
+            print(f"  remove {pkg.label} ({index.rel(pkg.path)}, {size / 1024:.0f} KB)")
+        except OSError:
+            pass
+
+    for node in list(index.iter_nodes()):
+        for name in sorted(node.links):
+            if index.exists(Path(os.path.normpath(node.path / node.links[name]))) is False:
+                try:
+                    index.remove_link(node, name)
+                except OSError:
+                    pass
 
     return removed, saved_bytes
 
 
+# ---------------------------------------------------------------------------
+# 9. Shared package store (--node-store)
+# ---------------------------------------------------------------------------
+
+
+def _locked_with_integrity(index: NodeModulesIndex, tree: Node, pkg: Node,
+                           locks: dict[Path, "yarn_lock.Lockfile | None"]) -> bool:
+    """True if the yarn.lock of *tree*'s app pins *pkg*'s version with an
+    ``integrity`` hash, i.e. its bytes are those of one registry tarball."""
+    lockfile = tree.path.parent / "yarn.lock"
+    if lockfile not in locks:
+        locks[lockfile] = yarn_lock.Lockfile.load(lockfile) if lockfile.is_file() else None
+    lock = locks[lockfile]
+    if lock is None:
+        return False
+    return any(entry.version == pkg.version and "integrity" in entry.fields
+               for entry in lock.entries(pkg.npm_name))
+
+
+def _store_candidates(index: NodeModulesIndex, store_tree: Node,
+                      hasher: ContentHasher) -> dict[str, Node]:
+    """Shared, stable top-level packages that can move to the store, by directory name.
+
+    A package qualifies when
+
+    - it is shared: symlinks from other places point at it,
+    - it is stable, keyed on content: its app's yarn.lock pins the
+      version with an integrity hash and every copy of that
+      name@version in the bench has the same tree digest – so the
+      stored bytes only change when a lockfile moves the version, not
+      when an app patches or rebuilds its own copy,
+    - none of its own symlinks leave it, and each dependency it resolves
+      today is either bundled inside it or is the copy chosen for the
+      store itself – Node resolves requires from the real path, so a
+      stored package only sees the store.
+
+    Of several copies with the same directory name the most-linked one is
+    chosen (then the lowest digest, so the choice does not depend on
+    which app was scanned first).
+    """
+    linked: dict[Path, int] = defaultdict(int)
+    for node in index.iter_nodes():
+        for name in node.links:
+            status, resolved = index.follow(node.path / name)
+            if status == "ok":
+                linked[resolved] += 1
+
+    locks: dict[Path, yarn_lock.Lockfile | None] = {}
+    shared: list[tuple[str, Node]] = []
+    for tree in index.trees:
+        if tree is store_tree:
+            continue
+        for pkg in iter_packages(tree):
+            if not pkg.key or not linked.get(pkg.path):
+                continue
+            if any(not Path(os.path.normpath(n.path / target)).is_relative_to(pkg.path)
+                   for n in pkg.iter_tree() for target in n.links.values()):
+                continue
+            if not _locked_with_integrity(index, tree, pkg, locks):
+                continue
+            shared.append((pkg.path.relative_to(tree.path).as_posix(), pkg))
+
+    # Every real copy of a candidate's name@version must hold the same bytes
+    keys = {pkg.key for _, pkg in shared}
+    copies = {key: nodes for key, nodes in _collect_all_packages(index).items() if key in keys}
+    digests = hasher.digests([node for nodes in copies.values() for node in nodes])
+
+    chosen: dict[str, Node] = {}
+    for name, pkg in shared:
+        if len({digests[node] for node in copies[pkg.key]}) != 1:
+            print(f"  {pkg.label}: copies differ – not stable, stays in place")
+            continue
+        best = chosen.get(name)
+        if best is None or ((-linked[pkg.path], digests[pkg])
+                            < (-linked[best.path], digests[best])):
+            chosen[name] = pkg
+
+    requires = {
+        pkg: {dep: index.resolve_package(pkg.path, dep)
+              for dep in _read_dependencies(index.disk_path(pkg.path / "package.json"),
+                                            _RUNTIME_DEP_FIELDS)}
+        for pkg in chosen.values()
+    }
+    changed = True
+    while changed:
+        changed = False
+        for name, pkg in list(chosen.items()):
+            for dep_name, dep in requires[pkg].items():
+                if (dep is not None and not dep.path.is_relative_to(pkg.path)
+                        and chosen.get(dep_name) is not dep):
+                    del chosen[name]
+                    changed = True
+                    break
+    return chosen
+
+
+def move_to_store(index: NodeModulesIndex, store: Path,
+                  hasher: ContentHasher | None = None) -> tuple[int, int]:
+    """Move shared packages into ``<store>/node_modules`` and link to them.
+
+    Every qualifying package (see :func:`_store_candidates`) is moved to
+    the store under its directory name, a symlink is left in its place
+    and the symlinks that pointed at it are re-pointed to the store.
+    Packages already in the store (earlier run) are left alone.  The
+    store is a plain node_modules tree, so the image can ``COPY`` it as
+    its own layer, which only changes when the shared packages do.
+
+    Returns (packages_moved, bytes_moved).
+    """
+    store_tree = next(tree for tree in index.trees if tree.path == store / "node_modules")
+    hasher = hasher or ContentHasher(index.jobs, locate=index.disk_path)
+    chosen = _store_candidates(index, store_tree, hasher)
+    if chosen and not index.dry_run:
+        store_tree.path.mkdir(parents=True, exist_ok=True)
+
+    moved = 0
+    moved_bytes = 0
+    for name in sorted(chosen):
+        pkg = chosen[name]
+        parent = store_tree
+        *scope, base = name.split("/")
+        for part in scope:
+            parent = index.make_dir(parent, part)
+        if base in parent.dirs or base in parent.links:
+            continue
+        size = pkg.size()
+        label = pkg.label
+        try:
+            index.move(pkg, parent, base, "store", leave_link=True)
+        except OSError as e:
+            print(f"  ✗ {label}: {e}")
+            continue
+        moved += 1
+        moved_bytes += size
+        print(f"  {label} ({size / 1024:.0f} KB)")
+    return moved, moved_bytes
+
+
+# ---------------------------------------------------------------------------
+# 10. Verify symlinks (final phase, or standalone with --verify)
+# ---------------------------------------------------------------------------
+
+
+def _promoted_note(index: NodeModulesIndex, promoted: Path | None) -> str:
+    if promoted is None:
+        return ""
+    return f" – still linked, promoted to {index.rel(promoted)}"
+
+
+def _surviving_copy(index: NodeModulesIndex, link: Path, target: Path) -> Node | None:
+    """A live copy of the package the dangling symlink *link* pointed to.
+
+    The package name is the one the link is required by; the version
+    comes from ``index.gone`` (packages removed in this run).  If that is
+    unknown, a copy is only chosen when all live copies of the package
+    share one version.
+    """
+    name = link.name
+    if link.parent.name.startswith("@"):
+        name = f"{link.parent.name}/{name}"
+    copies = [pkg for pkg in _iter_all_packages(index) if pkg.npm_name == name]
+    label = index.gone.get(target)
+    if label is not None:
+        copies = [pkg for pkg in copies if pkg.label == label]
+    elif len({pkg.version for pkg in copies}) != 1:
+        return None
+    return copies[0] if copies else None
+
+
+def verify_links(index: NodeModulesIndex) -> tuple[int, int, list[str]]:
+    """Resolve every symlink in every tree and repair what can be repaired.
+
+    - dangling ``.bin`` entries are removed (their package is gone),
+    - dangling package links are re-pointed to a surviving copy of the
+      same package (same version as the removed target),
+    - cycles and dangling links without a surviving copy are reported.
+
+    Links leaving the trees are not checked.  Returns (links_checked,
+    repaired, problems).
+    """
+    checked = 0
+    repaired = 0
+    problems = []
+    for node in list(index.iter_nodes()):
+        for name in sorted(node.links):
+            checked += 1
+            target = Path(os.path.normpath(node.path / node.links[name]))
+            status, _ = index.follow(target)
+            if status in ("ok", "external"):
+                continue
+            where = index.rel(node.path / name)
+            if status == "cycle":
+                problems.append(f"{where}: symlink cycle")
+                continue
+            try:
+                if node.path.name == ".bin":
+                    index.remove_link(node, name)
+                    print(f"  {where}: dangling, removed")
+                    repaired += 1
+                    continue
+                copy = _surviving_copy(index, node.path / name, target)
+                if copy is None:
+                    problems.append(f"{where} → {index.rel(target)}: target missing, "
+                                    f"no surviving copy")
+                    continue
+                index.relink(node, name, copy.path)
+                print(f"  {where}: {index.rel(target)} is gone → {index.rel(copy.path)}")
+                repaired += 1
+            except OSError as e:
+                problems.append(f"{where}: repair failed ({e})")
+    return checked, repaired, problems
+
+
+def check_lockfiles(index: NodeModulesIndex) -> list[str]:
+    """Cross-check top-level app packages against the app's yarn.lock.
+
+    A package whose version is neither locked nor accepted by one of the
+    locked ranges (``--hoist`` may pick another compatible version) has
+    drifted from the lockfile.  Packages the lock does not list at all
+    (added by patches) are not checked.  Returns one warning per drift.
+    """
+    warnings = []
+    for tree in index.trees:
+        lockfile = tree.path.parent / "yarn.lock"
+        if not _is_top_level_nm(tree.path, index.apps_dir) or not lockfile.is_file():
+            continue
+        lock = yarn_lock.Lockfile.load(lockfile)
+        names = [name for name in [*tree.dirs, *tree.links] if not name.startswith(".")]
+        for scope in [name for name in names if name.startswith("@") and name in tree.dirs]:
+            names.remove(scope)
+            names += [f"{scope}/{sub}" for sub in [*tree.dirs[scope].dirs, *tree.dirs[scope].links]]
+        for name in sorted(names):
+            entries = lock.entries(name)
+            pkg = index.resolve(tree.path / name)
+            if not entries or pkg is None or pkg.version is None:
+                continue
+            if pkg.version in lock.versions(name):
+                continue
+            ranges = [rng for entry in entries for rng in entry.ranges(name)]
+            if any(npm_semver.satisfies(pkg.version, rng) for rng in ranges):
+                continue
+            locked = ", ".join(sorted(lock.versions(name)))
+            warnings.append(f"{index.rel(tree.path / name)}: {pkg.version} installed, "
+                            f"yarn.lock has {locked}")
+    return warnings
+
+
+# ---------------------------------------------------------------------------
+# Manifest (--incremental)
+# ---------------------------------------------------------------------------
+
+MANIFEST_NAME = ".node_modules-manifest.json"
+MANIFEST_VERSION = 1
+
+
+class Manifest:
+    """What the previous run saw, persisted next to ``apps/``.
+
+    Holds the package keys (with the package.json stat they were read
+    from), the build-artifact package.json files left clean and the file
+    digest cache.  The next run uses it to skip work for everything that
+    did not change on disk:
+
+    - package.json of unchanged packages is not re-read,
+    - dedup / nested dedup / hoisting only handle groups with a new or
+      changed copy (see :meth:`changed`),
+    - file digests are not recomputed for unchanged files,
+    - build-artifact package.json already stripped are not re-parsed.
+
+    Cleanup, pruning and link verification still look at every tree:
+    they only act on what the scan finds, and a changed package can break
+    links anywhere.
+
+    A manifest written with different dedup options is ignored.
+    """
+
+    def __init__(self, path: Path, options: dict):
+        self.path = path
+        self.options = options
+        # rel package path → (FileStat of package.json, name, version)
+        self.packages: dict[str, tuple[FileStat, str | None, str | None]] = {}
+        # rel package.json path → FileStat, for files phase 5 left clean
+        self.checked: dict[str, FileStat] = {}
+        self.file_digests: dict[tuple[int, int, int], str] = {}
+
+    @classmethod
+    def load(cls, path: Path, options: dict) -> "Manifest":
+        """Read *path*; an unusable or mismatching manifest yields an empty one."""
+        manifest = cls(path, options)
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, json.JSONDecodeError):
+            return manifest
+        if (not isinstance(data, dict) or data.get("version") != MANIFEST_VERSION
+                or data.get("options") != options):
+            return manifest
+        for rel, pkg in data.get("packages", {}).items():
+            manifest.packages[rel] = (FileStat(*pkg["stat"]), pkg["name"], pkg["version"])
+        manifest.checked = {rel: FileStat(*st) for rel, st in data.get("checked", {}).items()}
+        manifest.file_digests = {(ino, mtime, size): digest
+                                 for ino, mtime, size, digest in data.get("file_digests", [])}
+        return manifest
+
+    def changed(self, index: NodeModulesIndex) -> set[Node]:
+        """Packages whose package.json is new or changed since the last run."""
+        changed = set()
+        for pkg in _iter_all_packages(index, keyed_only=False):
+            st = pkg.files.get("package.json")
+            if st is None:
+                continue
+            known = self.packages.get(index.rel(pkg.path))
+            if known is None or known[0] != st:
+                changed.add(pkg)
+        return changed
+
+    def diff(self, index: NodeModulesIndex, changed: set[Node]) -> dict[str, int]:
+        """Count packages that are unchanged / new or changed / gone since the last run."""
+        current = {index.rel(pkg.path) for pkg in _iter_all_packages(index, keyed_only=False)
+                   if "package.json" in pkg.files}
+        return {"unchanged": len(current) - len(changed), "changed": len(changed),
+                "gone": len(set(self.packages) - current)}
+
+    def save(self, index: NodeModulesIndex, hasher: ContentHasher | None,
+             phases: list[str]) -> None:
+        """Record the state *index* was left in after *phases*."""
+        packages = {}
+        for pkg in _iter_all_packages(index, keyed_only=False):
+            st = pkg.files.get("package.json")
+            if st is None or pkg.removed:
+                continue
+            packages[index.rel(pkg.path)] = {"name": pkg.npm_name, "version": pkg.version,
+                                             "stat": list(st)}
+
+        checked = {}
+        live_keys = set()
+        for node in index.iter_nodes():
+            for name, st in node.files.items():
+                live_keys.add((st.ino, st.mtime_ns, st.size))
+            st = node.files.get("package.json")
+            if ("strip_sbom" in phases and st is not None
+                    and not _is_root_package_json(node.path / "package.json")):
+                checked[index.rel(node.path / "package.json")] = list(st)
+
+        data = {
+            "version": MANIFEST_VERSION,
+            "options": self.options,
+            "packages": packages,
+            "checked": checked,
+            # Only digests of files that still exist – keeps the manifest bounded
+            "file_digests": [[*key, digest] for key, digest in
+                             (hasher.cache.items() if hasher else ()) if key in live_keys],
+        }
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(data, indent=1) + "\n")
+        os.replace(tmp, self.path)
+
+
+# ---------------------------------------------------------------------------
+# Savings report (--plan / --report)
+# ---------------------------------------------------------------------------
+
+
+def build_report(index: NodeModulesIndex, before: tuple[int, int],
+                 phases: list[str], top: int = 20) -> dict:
+    """Summarise ``index.changes`` as a JSON-serialisable report.
+
+    *before* is ``index.totals()`` taken before the first phase; *phases*
+    lists the phase names in the order they ran.
+    """
+    apps_dir = index.apps_dir
+    rel = index.rel
+
+    per_phase = {name: {"bytes": 0, "files": 0, "changes": 0} for name in phases}
+    per_package: dict[str, dict] = {}
+    for change in index.changes:
+        phase = per_phase.setdefault(change.phase, {"bytes": 0, "files": 0, "changes": 0})
+        phase["bytes"] += change.bytes
+        phase["files"] += change.files
+        phase["changes"] += 1
+        if change.package is None:
+            continue
+        pkg = per_package.setdefault(change.package,
+                                     {"package": change.package, "bytes": 0, "files": 0})
+        pkg["bytes"] += change.bytes
+        pkg["files"] += change.files
+
+    remaining = []
+    for pkg in _iter_all_packages(index, keyed_only=False):
+        if pkg.removed:
+            continue
+        remaining.append({"package": pkg.label, "path": rel(pkg.path),
+                          "bytes": pkg.size(), "files": pkg.file_count()})
+    remaining.sort(key=lambda r: (-r["bytes"], r["path"]))
+
+    after = index.totals()
+    return {
+        "apps_dir": str(apps_dir),
+        "dry_run": index.dry_run,
+        "trees": [rel(path) for path in index.nm_dirs],
+        "before": {"bytes": before[0], "files": before[1]},
+        "after": {"bytes": after[0], "files": after[1]},
+        "phases": [{"phase": name, **totals} for name, totals in per_phase.items()],
+        "packages": sorted(per_package.values(), key=lambda p: (-p["bytes"], p["package"])),
+        "largest_remaining": remaining[:top],
+    }
+
+
 # ---------------------------------------------------------------------------
 # Main
 # ---------------------------------------------------------------------------
 
 
-def main():
-    if len(sys.argv) < 2:
-        print(f"Usage: {sys.argv[0]} <apps-directory>")
-        sys.exit(1)
+def run_phases(index: NodeModulesIndex, opts: DedupOptions, dedup_only: bool = False,
+               manifest: Manifest | None = None, runtime: dict | None = None,
+               verify_only: bool = False,
+               store: Path | None = None) -> tuple[list[str], list[str]]:
+    """Run all phases in order and print a summary per phase.
 
-    apps_dir = Path(sys.argv[1])
-    if not apps_dir.is_dir():
-        print(f"Error: {apps_dir} is not a directory")
-        sys.exit(1)
+    *runtime* enables the reachability phase: ``{"entry-points": [...],
+    "keep": [...]}``; *store* moves shared packages to a separate tree
+    after all other phases.  Symlinks are verified last (or only, with
+    *verify_only*).  Returns the names of the phases that ran (see
+    :class:`Change`) and the link problems that could not be repaired.
+    """
+    phases = []
+
+    def start(name: str, title: str) -> None:
+        index.phase = name
+        phases.append(name)
+        print(f"\n--- {title} ---")
+
+    def verify() -> tuple[list[str], list[str]]:
+        start("verify", "Verify: symlink integrity")
+        checked, repaired, problems = verify_links(index)
+        for problem in problems:
+            print(f"  ✗ {problem}")
+        print(f"Checked {checked} symlinks, repaired {repaired}, "
+              f"{len(problems)} unrepairable")
+        drift = check_lockfiles(index)
+        for warning in drift:
+            print(f"  ⚠ {warning}")
+        if drift:
+            print(f"{len(drift)} packages differ from their app's yarn.lock")
+        return phases, problems
+
+    def move_shared() -> None:
+        if store is None:
+            return
+        start("store", f"Store: move shared packages to {store}")
+        moved, moved_bytes = move_to_store(index, store, opts.hasher)
+        print(f"Moved {moved} shared packages (~{moved_bytes / (1024 * 1024):.1f} MB) "
+              f"to the store")
 
-    # Discover all node_modules trees (including sub-apps like frappe/billing)
-    nm_dirs = find_all_node_modules(apps_dir)
-    print(f"Found {len(nm_dirs)} node_modules trees:")
-    for nm in nm_dirs:
-        print(f"  {nm.relative_to(apps_dir)}")
+    if verify_only:
+        return verify()
 
     # Phase 1: Deduplicate across trees (top-level packages, same npm name + version)
-    print("\n--- Phase 1: Cross-app deduplication (top-level) ---")
-    dedup_count, dedup_bytes = dedup(nm_dirs)
+    start("dedup", "Phase 1: Cross-app deduplication (top-level)")
+    dedup_count, dedup_bytes = dedup(index, opts)
     dedup_mb = dedup_bytes / (1024 * 1024)
     print(f"Deduplicated {dedup_count} packages, saved ~{dedup_mb:.1f} MB")
 
     # Phase 2: Deduplicate nested packages against top-level (cross-app)
-    print("\n--- Phase 2: Nested deduplication (nested → top-level) ---")
-    nested_count, nested_bytes = dedup_nested(nm_dirs, apps_dir)
+    start("dedup_nested", "Phase 2: Nested deduplication (nested → top-level)")
+    nested_count, nested_bytes = dedup_nested(index, opts)
     nested_mb = nested_bytes / (1024 * 1024)
     print(f"Replaced {nested_count} nested packages, saved ~{nested_mb:.1f} MB")
 
+    # Phase 2b: Collapse semver-compatible versions onto one copy
+    if opts.hoist:
+        start("hoist", "Phase 2b: Range-aware hoisting"
+              + (" (strict: same major only)" if opts.hoist_strict else ""))
+        hoist_count, hoist_bytes = hoist_compatible(index, opts.hoist_strict, opts.changed)
+        nested_bytes += hoist_bytes
+        print(f"Hoisted {hoist_count} packages onto compatible versions, "
+              f"saved ~{hoist_bytes / (1024 * 1024):.1f} MB")
+
+    if dedup_only:
+        total_mb = (dedup_bytes + nested_bytes) / (1024 * 1024)
+        print(f"\n=== Total savings: ~{total_mb:.1f} MB ===")
+        move_shared()
+        return verify()
+
     # Phase 3: Clean unnecessary files from all trees
-    print("\n--- Phase 3: Cleanup ---")
-    dirs_rm, files_rm, dirs_bytes, files_bytes = clean(nm_dirs)
+    start("clean", "Phase 3: Cleanup")
+    dirs_rm, files_rm, dirs_bytes, files_bytes = clean(index)
     clean_mb = (dirs_bytes + files_bytes) / (1024 * 1024)
     print(f"Removed {dirs_rm} directories and {files_rm} files, saved ~{clean_mb:.1f} MB")
 
     # Phase 4: Prune devDependencies
-    print("\n--- Phase 4: Prune devDependencies ---")
-    prune_count, prune_bytes = prune_dev_deps(nm_dirs)
+    start("prune_dev_deps", "Phase 4: Prune devDependencies")
+    prune_count, prune_bytes = prune_dev_deps(index)
     prune_mb = prune_bytes / (1024 * 1024)
     print(f"Pruned {prune_count} devDependency packages, saved ~{prune_mb:.1f} MB")
 
     # Phase 5: Strip SBOM metadata from build-artifact package.json
-    print("\n--- Phase 5: Strip SBOM metadata from build artifacts ---")
-    stripped = strip_sbom_from_build_artifacts(nm_dirs)
+    start("strip_sbom", "Phase 5: Strip SBOM metadata from build artifacts")
+    stripped = strip_sbom_from_build_artifacts(index, manifest.checked if manifest else None)
     print(f"Stripped SBOM fields from {stripped} non-root package.json files")
 
     # Phase 6: Remove build-only packages
-    print("\n--- Phase 6: Remove build-only packages ---")
-    build_rm, build_bytes = remove_build_only(nm_dirs)
+    start("remove_build_only", "Phase 6: Remove build-only packages")
+    build_rm, build_bytes = remove_build_only(index)
     build_mb = build_bytes / (1024 * 1024)
     print(f"Removed {build_rm} build-only packages, saved ~{build_mb:.1f} MB")
 
+    # Phase 7: Remove everything the runtime entry points cannot reach
+    unreachable_bytes = 0
+    if runtime is not None:
+        start("prune_unreachable", "Phase 7: Prune packages unreachable at runtime")
+        unreachable_rm, unreachable_bytes = prune_unreachable(
+            index, runtime["entry-points"], runtime.get("keep", ()))
+        unreachable_mb = unreachable_bytes / (1024 * 1024)
+        print(f"Removed {unreachable_rm} unreachable packages, saved ~{unreachable_mb:.1f} MB")
+
     total_mb = (dedup_bytes + nested_bytes + dirs_bytes + files_bytes
-                + prune_bytes + build_bytes) / (1024 * 1024)
+                + prune_bytes + build_bytes + unreachable_bytes) / (1024 * 1024)
     print(f"\n=== Total savings: ~{total_mb:.1f} MB ===")
+    move_shared()
+    return verify()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Optimize node_modules across Frappe bench apps")
+    parser.add_argument("apps_dir", type=Path, help="Bench apps directory")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1,
+                        help="Worker threads for scanning and package.json reads "
+                             "(default: CPU count, 1 = serial)")
+    parser.add_argument("--verify-content", action="store_true",
+                        help="Only merge copies whose content digest matches "
+                             "(same name + version but different bytes are kept)")
+    parser.add_argument("--by-content", action="store_true",
+                        help="Group packages by content digest instead of name + version "
+                             "(implies --verify-content)")
+    parser.add_argument("--strategy", choices=STRATEGIES, default="symlink",
+                        help="How duplicates are merged: symlink the package dir (default), "
+                             "or keep the dir and hardlink / reflink identical files")
+    parser.add_argument("--hoist", action="store_true",
+                        help="Replace older package versions with a newer copy that satisfies "
+                             "every dependent's declared semver range")
+    parser.add_argument("--hoist-strict", action="store_true",
+                        help="Like --hoist, but never substitute across a major version")
+    parser.add_argument("--dedup-only", action="store_true",
+                        help="Run only the dedup phases (1 + 2), e.g. inside the dev volume")
+    parser.add_argument("--plan", action="store_true",
+                        help="Dry run: run every phase against the index only and print a "
+                             "JSON savings report (nothing on disk is changed)")
+    parser.add_argument("--report", type=Path, metavar="FILE",
+                        help="Write the JSON savings report to FILE (with or without --plan)")
+    parser.add_argument("--top", type=int, default=20, metavar="N",
+                        help="Number of largest remaining packages in the report (default: 20)")
+    parser.add_argument("--config", type=Path, metavar="PYPROJECT",
+                        help="pyproject.toml with [tool.ops.overrides.node-modules-cleanup] "
+                             "rules (default: built-in rules only)")
+    parser.add_argument("--prune-unreachable", action="store_true",
+                        help="Release only: remove every package the Node entry points "
+                             "cannot reach (see --entry)")
+    parser.add_argument("--entry", action="append", metavar="PATH",
+                        help="Runtime entry point relative to the apps dir, repeatable "
+                             f"(default: {', '.join(DEFAULT_ENTRY_POINTS)} plus "
+                             "entry-points from --config)")
+    parser.add_argument("--node-store", type=Path, metavar="DIR",
+                        help="Move shared packages that yarn.lock pins with an integrity hash "
+                             "and that are byte-identical wherever installed to "
+                             "DIR/node_modules and symlink to them, for a separate image "
+                             "layer (implies --verify-content)")
+    parser.add_argument("--verify", action="store_true",
+                        help="Only verify (and repair) the symlinks in the trees; exit 1 "
+                             "on dangling or cyclic links that cannot be repaired")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Reuse the manifest of the previous run and write a new one")
+    parser.add_argument("--manifest", type=Path, metavar="FILE",
+                        help=f"Manifest path for --incremental (default: <apps-dir>/../{MANIFEST_NAME})")
+    args = parser.parse_args()
+    jobs = max(1, args.jobs)
+
+    apps_dir = args.apps_dir
+    if not apps_dir.is_dir():
+        print(f"Error: {apps_dir} is not a directory")
+        sys.exit(1)
+
+    if args.strategy == "reflink" and not args.plan and not _reflink_supported(apps_dir):
+        print(f"Error: {apps_dir} does not support reflinks – use --strategy hardlink or symlink")
+        sys.exit(1)
+
+    # --plan without --report: JSON on stdout, progress log on stderr
+    json_to_stdout = args.plan and args.report is None
+    with contextlib.redirect_stdout(sys.stderr if json_to_stdout else sys.stdout):
+        manifest = None
+        if args.incremental:
+            options = {"strategy": args.strategy, "verify_content": args.verify_content,
+                       "by_content": args.by_content, "dedup_only": args.dedup_only,
+                       "node_store": str(args.node_store) if args.node_store else None}
+            manifest = Manifest.load(args.manifest or apps_dir.resolve().parent / MANIFEST_NAME,
+                                     options)
+
+        # Discover and index all node_modules trees (including sub-apps like
+        # frappe/billing) in a single pass
+        rules = CleanupRules.from_pyproject(args.config) if args.config else None
+        index = NodeModulesIndex.build(apps_dir, jobs=jobs,
+                                       meta_cache=manifest.packages if manifest else None,
+                                       rules=rules, store=args.node_store)
+        index.dry_run = args.plan
+        before = index.totals()
+        print(f"Found {len(index.trees)} node_modules trees:")
+        for nm in index.nm_dirs:
+            print(f"  {index.rel(nm)}")
+        changed = None
+        if manifest is not None:
+            changed = manifest.changed(index)
+            diff = manifest.diff(index, changed)
+            print(f"Incremental: {diff['unchanged']} packages unchanged, "
+                  f"{diff['changed']} new or changed, {diff['gone']} gone")
+
+        # Everything linked into the store must be byte-identical to it
+        verify_content = args.verify_content or args.node_store is not None
+        opts = DedupOptions(strategy=args.strategy, verify_content=verify_content,
+                            by_content=args.by_content, hoist=args.hoist or args.hoist_strict,
+                            hoist_strict=args.hoist_strict, changed=changed)
+        if opts.verify_content or opts.by_content or opts.strategy != "symlink":
+            opts.hasher = ContentHasher(jobs, manifest.file_digests if manifest else None,
+                                        index.disk_path)
+        runtime = None
+        if args.prune_unreachable:
+            section = (_read_toml_section(args.config, *RUNTIME_SECTION) if args.config else None) or {}
+            runtime = {
+                "entry-points": args.entry or [*DEFAULT_ENTRY_POINTS, *section.get("entry-points", [])],
+                "keep": section.get("keep", []),
+            }
+        phases, problems = run_phases(index, opts, args.dedup_only, manifest, runtime,
+                                      verify_only=args.verify, store=args.node_store)
+
+        if manifest is not None and not args.plan:
+            manifest.save(index, opts.hasher, phases)
+            print(f"Manifest written to {manifest.path}")
+
+    if args.report is not None or args.plan:
+        report = build_report(index, before, phases, args.top)
+        text = json.dumps(report, indent=2) + "\n"
+        if args.report is None:
+            sys.stdout.write(text)
+        else:
+            args.report.write_text(text)
+            print(f"Report written to {args.report}")
+    if problems:
+        print(f"Error: {len(problems)} broken symlinks could not be repaired", file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""Benchmark dedup_node_modules.py on synthetic node_modules trees.
+
+Builds ``apps/*/node_modules`` trees of a configurable shape (app count,
+packages per app, nesting depth, scoped share, duplicate ratio, files per
+package) and times every phase of dedup_node_modules.py on them.  Needs
+nothing but the standard library and runs offline.
+
+Per phase it reports:
+
+  wall      – elapsed time
+  cpu       – user + system CPU time of this process
+  fs ops    – filesystem calls seen by Python audit hooks (open, scandir,
+              unlink, rename, link, symlink, rmtree, …); ``stat`` has no
+              audit event, use ``--strace`` for exact syscall counts
+  io calls  – read/write syscalls from /proc/self/io (Linux)
+  peak RSS  – high-water mark of the process after the phase
+
+``check-plan`` instead runs every strategy, with and without
+``--prune-unreachable``, twice on copies of one tree – as ``--plan`` and
+for real – and fails unless the planned savings equal the real
+before/after difference.  ``check-prune`` runs the script itself with
+``--prune-unreachable`` on a tiny fixture (one package the entry point
+reaches, one it does not) and checks what the plan and the real run
+remove.
+
+Usage:
+    python3 dedup_node_modules_bench.py run [shape options] [--repeat N] [--json]
+    python3 dedup_node_modules_bench.py check-plan [shape options]
+    python3 dedup_node_modules_bench.py check-prune
+    python3 dedup_node_modules_bench.py generate <dir> [shape options]
+
+Examples:
+    # Default shape (4 apps × 300 packages), three runs, median per phase
+    python3 dedup_node_modules_bench.py run --repeat 3
+
+    # Large, deep tree with content verification and 8 workers
+    python3 dedup_node_modules_bench.py run --apps 7 --packages 1500 --depth 3 \\
+        --verify-content --jobs 8
+
+    # Exact syscall totals for the whole run (needs strace)
+    python3 dedup_node_modules_bench.py run --strace
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import dedup_node_modules as dnm  # noqa: E402
+
+# ---------------------------------------------------------------------------
+# Synthetic tree generator
+# ---------------------------------------------------------------------------
+
+
+@dataclass
+class TreeShape:
+    """Shape of a synthetic bench ``apps/`` directory."""
+    apps: int = 4             # apps with a node_modules tree (first is "frappe")
+    packages: int = 300       # top-level packages per app
+    depth: int = 2            # max node_modules nesting below top level
+    nested: int = 3           # packages inside each nested node_modules
+    nest_ratio: float = 0.2   # share of packages carrying a nested node_modules
+    scoped: float = 0.1       # share of @scope/name packages
+    duplicates: float = 0.6   # share of packages shared (same name + version + bytes)
+    files: int = 12           # files per package (incl. package.json)
+    file_size: int = 2048     # bytes per regular file
+    sub_app: bool = True      # add a frappe/billing/node_modules sub-app tree
+    seed: int = 0
+
+
+# Per-package file layout, cycled through up to TreeShape.files.  Mixes
+# runtime files with everything clean() and the SBOM strip act on.
+_PACKAGE_FILES = (
+    "index.js", "README.md", "LICENSE", "index.js.map", "lib/a.js",
+    "dist/package.json", "test/a.test.js", "CHANGELOG.md", "lib/b.js",
+    "lib/b.js.map", "tsconfig.json", "docs/usage.md", "examples/demo.js",
+)
+
+
+def _content(seed: str, size: int) -> bytes:
+    line = f"// {seed}\n".encode()
+    return (line * (size // len(line) + 1))[:size]
+
+
+def _write_package(path: Path, name: str, version: str, shape: TreeShape,
+                   deps: dict | None = None) -> None:
+    path.mkdir(parents=True, exist_ok=True)
+    (path / "package.json").write_text(json.dumps(
+        {"name": name, "version": version, "description": "synthetic",
+         "license": "MIT", "main": "index.js", "dependencies": deps or {}}, indent=2) + "\n")
+    for i in range(max(0, shape.files - 1)):
+        rel = _PACKAGE_FILES[i] if i < len(_PACKAGE_FILES) else f"lib/f{i}.js"
+        target = path / rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if rel == "dist/package.json":
+            target.write_text(json.dumps({"name": name, "type": "module"}, indent=2) + "\n")
+        else:
+            # Same name + version → same bytes, so --verify-content merges them
+            target.write_bytes(_content(f"{name}@{version}/{rel}", shape.file_size))
+
+
+def _package_name(rng: random.Random, index: int, shape: TreeShape) -> str:
+    if rng.random() < shape.scoped:
+        return f"@scope{index % 7}/pkg{index}"
+    return f"pkg{index}"
+
+
+def generate_tree(apps_dir: Path, shape: TreeShape) -> dict:
+    """Create a synthetic bench ``apps/`` directory; returns summary counts."""
+    rng = random.Random(shape.seed)
+    shared = [(_package_name(rng, i, shape), f"1.{i % 5}.0") for i in range(shape.packages)]
+    # Packages dnm removes by name (remove_build_only) are always shared
+    shared[:2] = [("rimraf", "3.0.2"), ("glob", "7.2.3")]
+    counts = {"packages": 0, "files": 0}
+
+    def add(path: Path, name: str, version: str, level: int) -> None:
+        deps = {}
+        if level < shape.depth and rng.random() < shape.nest_ratio:
+            for sub_name, sub_version in rng.sample(shared, min(shape.nested, len(shared))):
+                deps[sub_name] = sub_version
+                add(path / "node_modules" / sub_name, sub_name, sub_version, level + 1)
+        _write_package(path, name, version, shape, deps)
+        counts["packages"] += 1
+        counts["files"] += max(1, shape.files)
+
+    app_names = ["frappe"] + [f"app{i}" for i in range(1, shape.apps)]
+    trees = [apps_dir / name for name in app_names]
+    if shape.sub_app and shape.apps:
+        trees.append(apps_dir / "frappe" / "billing")
+
+    for app_dir in trees:
+        nm = app_dir / "node_modules"
+        nm.mkdir(parents=True)
+        packages = {}
+        for i, (name, version) in enumerate(shared):
+            if i >= 2 and rng.random() >= shape.duplicates:
+                # Not shared: same name with an app-specific version
+                version = f"2.{rng.randrange(100)}.0"
+            packages[name] = version
+            add(nm / name, name, version, 0)
+        names = sorted(packages)
+        dev = names[: max(1, len(names) // 10)]
+        (app_dir / "package.json").write_text(json.dumps({
+            "name": app_dir.name,
+            "dependencies": {n: packages[n] for n in names if n not in dev},
+            "devDependencies": {n: packages[n] for n in dev},
+        }, indent=2) + "\n")
+    return counts
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+# Audit events (sys.addaudithook) that correspond to filesystem syscalls
+_FS_EVENTS = frozenset({
+    "open", "os.scandir", "os.listdir", "os.remove", "os.rmdir", "os.rename",
+    "os.link", "os.symlink", "os.truncate", "os.chmod", "shutil.rmtree",
+    "shutil.copyfile", "shutil.copymode", "fcntl.ioctl",
+})
+_fs_ops = {"count": 0}
+
+
+def _audit(event: str, _args) -> None:
+    if event in _FS_EVENTS:
+        _fs_ops["count"] += 1
+
+
+def _io_syscalls() -> int | None:
+    """read + write syscalls of this process so far (None if unavailable)."""
+    try:
+        fields = dict(line.split(": ") for line in Path("/proc/self/io").read_text().splitlines())
+        return int(fields["syscr"]) + int(fields["syscw"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+@contextlib.contextmanager
+def measure(results: dict, name: str):
+    """Record wall/cpu time, fs ops, io syscalls and peak RSS of the block."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    io = _io_syscalls()
+    ops = _fs_ops["count"]
+    start = time.perf_counter()
+    yield
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    io_after = _io_syscalls()
+    results[name] = {
+        "wall_s": wall,
+        "cpu_s": (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime),
+        "fs_ops": _fs_ops["count"] - ops,
+        "io_syscalls": io_after - io if io is not None and io_after is not None else None,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def run_once(apps_dir: Path, opts: dnm.DedupOptions, jobs: int, verbose: bool) -> dict:
+    """Index *apps_dir* and run every phase once; returns per-phase metrics."""
+    results: dict[str, dict] = {}
+    log = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with log:
+        with measure(results, "index"):
+            index = dnm.NodeModulesIndex.build(apps_dir, jobs=jobs)
+        phases = [
+            ("dedup", lambda: dnm.dedup(index, opts)),
+            ("dedup_nested", lambda: dnm.dedup_nested(index, opts)),
+            ("clean", lambda: dnm.clean(index)),
+            ("prune_dev_deps", lambda: dnm.prune_dev_deps(index)),
+            ("strip_sbom", lambda: dnm.strip_sbom_from_build_artifacts(index)),
+            ("remove_build_only", lambda: dnm.remove_build_only(index)),
+        ]
+        for name, phase in phases:
+            index.phase = name
+            with measure(results, name):
+                phase()
+    for name in results:
+        changes = [c for c in index.changes if c.phase == name]
+        results[name]["bytes_freed"] = sum(c.bytes for c in changes)
+        results[name]["changes"] = len(changes)
+    return results
+
+
+def write_entry_point(apps_dir: Path) -> None:
+    """Give the synthetic frappe a ``socketio.js`` requiring half its dependencies.
+
+    The default entry point of ``--prune-unreachable``; everything else
+    in the trees becomes unreachable.
+    """
+    deps = sorted(json.loads((apps_dir / "frappe" / "package.json").read_text())["dependencies"])
+    (apps_dir / "frappe" / "socketio.js").write_text(
+        "".join(f'require("{name}");\n' for name in deps[::2]))
+
+
+def check_plan(apps_dir: Path, strategy: str, jobs: int,
+               prune_unreachable: bool = False) -> tuple[int, int]:
+    """Plan, then really run, every phase on *apps_dir* with *strategy*.
+
+    Returns (planned bytes, real bytes): the sum of the plan's per-phase
+    savings and the difference of a fresh scan before and after the run.
+    A fresh scan cannot see reflinked extents, so for reflink the real
+    run's own index (which does) supplies the "after" side.
+    """
+    def run(dry_run: bool) -> dnm.NodeModulesIndex:
+        index = dnm.NodeModulesIndex.build(apps_dir, jobs=jobs)
+        index.dry_run = dry_run
+        opts = dnm.DedupOptions(strategy=strategy, hoist=True)
+        if strategy != "symlink":
+            opts.hasher = dnm.ContentHasher(jobs, locate=index.disk_path)
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            dnm.run_phases(index, opts, runtime=runtime)
+        return index
+
+    runtime = None
+    if prune_unreachable:
+        runtime = {"entry-points": list(dnm.DEFAULT_ENTRY_POINTS), "keep": []}
+
+    planned = sum(c.bytes for c in run(dry_run=True).changes)
+    before = dnm.NodeModulesIndex.build(apps_dir, jobs=jobs).totals()[0]
+    index = run(dry_run=False)
+    if strategy != "reflink":
+        index = dnm.NodeModulesIndex.build(apps_dir, jobs=jobs)
+    return planned, before - index.totals()[0]
+
+
+def write_prune_fixture(apps_dir: Path) -> None:
+    """One app whose socketio.js requires ``alive`` (which requires ``helper``);
+    ``dead`` is installed but nothing reaches it."""
+    app = apps_dir / "frappe"
+    packages = {"alive": {"helper": "1.0.0"}, "helper": {}, "dead": {}}
+    for name, deps in packages.items():
+        pkg = app / "node_modules" / name
+        pkg.mkdir(parents=True)
+        (pkg / "package.json").write_text(json.dumps(
+            {"name": name, "version": "1.0.0", "main": "index.js", "dependencies": deps},
+            indent=2) + "\n")
+        (pkg / "index.js").write_text(
+            "".join(f'require("{dep}");\n' for dep in deps) + f"module.exports = '{name}';\n")
+    (app / "package.json").write_text(json.dumps(
+        {"name": "frappe", "dependencies": {name: "1.0.0" for name in packages}}, indent=2) + "\n")
+    (app / "socketio.js").write_text('require("alive");\n')
+
+
+def check_prune(tmp: Path) -> list[str]:
+    """Plan and really run ``--prune-unreachable`` on the fixture; returns failures."""
+    apps_dir = tmp / "apps"
+    write_prune_fixture(apps_dir)
+    script = [sys.executable, dnm.__file__, str(apps_dir), "--prune-unreachable", "-j", "1"]
+
+    def removed(report: dict) -> list[str]:
+        return sorted(p["package"] for p in report["packages"])
+
+    def remaining(report: dict) -> list[str]:
+        return sorted(p["package"] for p in report["largest_remaining"])
+
+    def pruned_bytes(report: dict) -> int:
+        return next(p["bytes"] for p in report["phases"] if p["phase"] == "prune_unreachable")
+
+    plan = subprocess.run([*script, "--plan"], capture_output=True, text=True)
+    if plan.returncode != 0:
+        return [f"--plan exited with {plan.returncode}: {plan.stderr.strip()[-300:]}"]
+    planned = json.loads(plan.stdout)
+    real_out = tmp / "real.json"
+    real = subprocess.run([*script, "--report", str(real_out)], capture_output=True, text=True)
+    if real.returncode != 0:
+        return [f"real run exited with {real.returncode}: {real.stdout.strip()[-300:]}"]
+    report = json.loads(real_out.read_text())
+
+    failures = []
+    if removed(planned) != ["dead@1.0.0"] or remaining(planned) != ["alive@1.0.0", "helper@1.0.0"]:
+        failures.append(f"--plan removes {removed(planned)} and keeps {remaining(planned)}, "
+                        "expected to remove only dead@1.0.0")
+    nm = apps_dir / "frappe" / "node_modules"
+    left = sorted(p.name for p in nm.iterdir() if not p.name.startswith("."))
+    if left != ["alive", "helper"]:
+        failures.append(f"real run left {left}, expected ['alive', 'helper']")
+    if pruned_bytes(planned) != pruned_bytes(report):
+        failures.append(f"pruned bytes differ: plan {pruned_bytes(planned)}, "
+                        f"real {pruned_bytes(report)}")
+    return failures
+
+
+def summarize(runs: list[dict]) -> dict:
+    """Median of every numeric metric per phase across *runs*."""
+    summary = {}
+    for name in runs[0]:
+        summary[name] = {}
+        for metric, value in runs[0][name].items():
+            values = [run[name][metric] for run in runs if run[name][metric] is not None]
+            summary[name][metric] = statistics.median(values) if values else None
+    return summary
+
+
+def print_table(summary: dict) -> None:
+    print(f"{'phase':<20}{'wall s':>9}{'cpu s':>9}{'fs ops':>10}{'io calls':>10}"
+          f"{'peak MB':>9}{'freed MB':>10}")
+    for name, m in summary.items():
+        io = f"{m['io_syscalls']:.0f}" if m["io_syscalls"] is not None else "-"
+        print(f"{name:<20}{m['wall_s']:>9.3f}{m['cpu_s']:>9.3f}{m['fs_ops']:>10.0f}{io:>10}"
+              f"{m['peak_rss_mb']:>9.1f}{m['bytes_freed'] / (1024 * 1024):>10.2f}")
+    total = sum(m["wall_s"] for m in summary.values())
+    print(f"{'total':<20}{total:>9.3f}")
+
+
+def _strace(argv: list[str]) -> int:
+    """Re-run this benchmark under ``strace -f -c`` and print its summary."""
+    if shutil.which("strace") is None:
+        print("Error: strace not found")
+        return 1
+    with tempfile.NamedTemporaryFile(suffix=".strace") as out:
+        cmd = ["strace", "-f", "-c", "-o", out.name, sys.executable, __file__, *argv]
+        rc = subprocess.call(cmd)
+        print("\n--- strace -c (all phases incl. tree generation) ---")
+        print(Path(out.name).read_text())
+    return rc
+
+
+# ---------------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------------
+
+
+def _add_shape_args(parser: argparse.ArgumentParser) -> None:
+    defaults = TreeShape()
+    for field, value in asdict(defaults).items():
+        flag = "--" + field.replace("_", "-")
+        if isinstance(value, bool):
+            parser.add_argument(flag, action=argparse.BooleanOptionalAction, default=value)
+        else:
+            parser.add_argument(flag, type=type(value), default=value,
+                                help=f"(default: {value})")
+
+
+def _shape_from_args(args) -> TreeShape:
+    return TreeShape(**{field: getattr(args, field) for field in asdict(TreeShape())})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dedup_node_modules.py")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="Write a synthetic apps/ tree")
+    gen.add_argument("apps_dir", type=Path)
+    _add_shape_args(gen)
+
+    check = sub.add_parser("check-plan",
+                           help="Check that --plan predicts the real savings of every strategy")
+    _add_shape_args(check)
+    check.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1)
+    check.add_argument("--workdir", type=Path, help="Where to build trees (default: temp dir)")
+
+    sub.add_parser("check-prune",
+                   help="Check --prune-unreachable (plan and real run) on a tiny fixture")
+
+    run = sub.add_parser("run", help="Time every phase on fresh synthetic trees")
+    _add_shape_args(run)
+    run.add_argument("--repeat", type=int, default=1, help="Runs (median is reported)")
+    run.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1)
+    run.add_argument("--strategy", choices=dnm.STRATEGIES, default="symlink")
+    run.add_argument("--verify-content", action="store_true")
+    run.add_argument("--by-content", action="store_true")
+    run.add_argument("--workdir", type=Path, help="Where to build trees (default: temp dir)")
+    run.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    run.add_argument("--verbose", "-v", action="store_true", help="Show the phases' own output")
+    run.add_argument("--strace", action="store_true",
+                     help="Run under strace -f -c and print exact syscall counts")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        if args.apps_dir.exists():
+            print(f"Error: {args.apps_dir} already exists")
+            sys.exit(1)
+        counts = generate_tree(args.apps_dir, _shape_from_args(args))
+        print(f"Generated {counts['packages']} packages, {counts['files']} files "
+              f"in {args.apps_dir}")
+        return
+
+    if args.command == "check-plan":
+        failed = False
+        with tempfile.TemporaryDirectory(dir=args.workdir) as tmp:
+            template = Path(tmp) / "template"
+            generate_tree(template, _shape_from_args(args))
+            write_entry_point(template)
+            for strategy in dnm.STRATEGIES:
+                for prune in (False, True):
+                    label = strategy + (" +prune" if prune else "")
+                    apps_dir = Path(tmp) / label.replace(" +", "-")
+                    shutil.copytree(template, apps_dir, symlinks=True)
+                    if strategy == "reflink" and not dnm._reflink_supported(apps_dir):
+                        print(f"{label:<16} skipped (no reflink support in {tmp})")
+                        continue
+                    planned, real = check_plan(apps_dir, strategy, max(1, args.jobs), prune)
+                    ok = planned == real
+                    failed |= not ok
+                    print(f"{label:<16} planned {planned:>12} B  real {real:>12} B  "
+                          f"{'ok' if ok else 'MISMATCH'}")
+        sys.exit(1 if failed else 0)
+
+    if args.command == "check-prune":
+        with tempfile.TemporaryDirectory() as tmp:
+            failures = check_prune(Path(tmp))
+        for failure in failures:
+            print(f"✗ {failure}")
+        print("prune-unreachable: " + ("FAILED" if failures else "ok"))
+        sys.exit(1 if failures else 0)
+
+    if args.strace:
+        argv = [a for a in sys.argv[1:] if a != "--strace"]
+        sys.exit(_strace(argv))
+
+    shape = _shape_from_args(args)
+    jobs = max(1, args.jobs)
+    sys.addaudithook(_audit)
+
+    runs = []
+    for i in range(max(1, args.repeat)):
+        with tempfile.TemporaryDirectory(dir=args.workdir) as tmp:
+            apps_dir = Path(tmp) / "apps"
+            counts = generate_tree(apps_dir, shape)
+            opts = dnm.DedupOptions(strategy=args.strategy, verify_content=args.verify_content,
+                                    by_content=args.by_content)
+            if opts.verify_content or opts.by_content or opts.strategy != "symlink":
+                opts.hasher = dnm.ContentHasher(jobs)
+            runs.append(run_once(apps_dir, opts, jobs, args.verbose))
+        if not args.json:
+            print(f"run {i + 1}: {counts['packages']} packages, {counts['files']} files, "
+                  f"{sum(m['wall_s'] for m in runs[-1].values()):.3f} s", file=sys.stderr)
+
+    summary = summarize(runs)
+    if args.json:
+        print(json.dumps({"shape": asdict(shape), "jobs": jobs, "strategy": args.strategy,
+                          "runs": len(runs), "phases": summary}, indent=2))
+    else:
+        print_table(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Minimal npm-compatible semver: versions, ranges and ``satisfies``.
+
+Implements the subset of node-semver that package.json dependency ranges
+use: comparators (``<``, ``<=``, ``>``, ``>=``, ``=``), caret and tilde
+ranges, x-ranges (``1.x``, ``1.2``, ``*``), hyphen ranges (``1.2 - 2``),
+``||`` alternatives and the prerelease rule (a prerelease version only
+matches a comparator set that names the same ``major.minor.patch`` with a
+prerelease).
+
+Anything that is not a semver range – dist-tags (``latest``), URLs, git
+and ``file:`` specs, ``npm:`` aliases – parses to ``None`` ("unknown"),
+and callers must treat it as "do not touch".
+
+Standard library only; used by dedup_node_modules.py.
+"""
+
+import re
+from typing import NamedTuple
+
+_VERSION_RE = re.compile(
+    r"^\s*[v=]*\s*(\d+)\.(\d+)\.(\d+)"
+    r"(?:-([0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*))?"
+    r"(?:\+[0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*)?\s*$")
+# Partial version inside a range: 1, 1.2, 1.2.3, 1.x, 1.2.*, with prerelease
+_PARTIAL_RE = re.compile(
+    r"^[v=]*(\d+|[xX*])(?:\.(\d+|[xX*]))?(?:\.(\d+|[xX*]))?"
+    r"(?:-([0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*))?"
+    r"(?:\+[0-9A-Za-z-]+(?:\.[0-9A-Za-z-]+)*)?$")
+_COMPARATOR_RE = re.compile(r"^(<=|>=|<|>|=|\^|~>?)?(.*)$")
+_HYPHEN_RE = re.compile(r"^\s*(\S+)\s+-\s+(\S+)\s*$")
+
+
+class Version(NamedTuple):
+    major: int
+    minor: int
+    patch: int
+    prerelease: tuple[str, ...] = ()
+
+    @property
+    def key(self) -> tuple:
+        """Sort key implementing semver precedence."""
+        pre = tuple((0, int(p), "") if p.isdigit() else (1, 0, p) for p in self.prerelease)
+        return self.major, self.minor, self.patch, 0 if self.prerelease else 1, pre
+
+    def __str__(self) -> str:
+        base = f"{self.major}.{self.minor}.{self.patch}"
+        return f"{base}-{'.'.join(self.prerelease)}" if self.prerelease else base
+
+
+def parse_version(text: str) -> Version | None:
+    """Parse an exact version (``1.2.3``, ``v1.2.3-beta.1+build``)."""
+    match = _VERSION_RE.match(text or "")
+    if not match:
+        return None
+    major, minor, patch, pre = match.groups()
+    return Version(int(major), int(minor), int(patch), tuple(pre.split(".")) if pre else ())
+
+
+# A comparator is (operator, Version); a range is a list of comparator sets
+# (``||`` alternatives), each satisfied when all its comparators are.
+Comparator = tuple[str, Version]
+
+
+def _partial(text: str):
+    """Return (major, minor, patch, prerelease) with None for wildcards."""
+    match = _PARTIAL_RE.match(text)
+    if not match:
+        return None
+    parts = [None if p is None or p in "xX*" else int(p) for p in match.groups()[:3]]
+    # Anything after a wildcard is a wildcard too (1.x.3 == 1.x)
+    for i in range(1, 3):
+        if parts[i - 1] is None:
+            parts[i] = None
+    pre = tuple(match.group(4).split(".")) if match.group(4) else ()
+    return parts[0], parts[1], parts[2], pre
+
+
+def _floor(major, minor, patch, pre=()) -> Version:
+    return Version(major or 0, minor or 0, patch or 0, pre if patch is not None else ())
+
+
+def _expand(op: str, text: str) -> list[Comparator] | None:
+    """Desugar one comparator token into primitive comparators."""
+    parts = _partial(text) if text else (None, None, None, ())
+    if parts is None:
+        return None
+    major, minor, patch, pre = parts
+    if major is None:
+        # "*", "x", "": any version – except "<*" / ">*", which match nothing
+        if op in ("<", ">"):
+            return [("<", Version(0, 0, 0, ("0",)))]
+        return [(">=", Version(0, 0, 0))]
+    low = _floor(major, minor, patch, pre)
+
+    if op in ("~", "~>"):
+        if minor is None:
+            return [(">=", low), ("<", Version(major + 1, 0, 0, ("0",)))]
+        return [(">=", low), ("<", Version(major, minor + 1, 0, ("0",)))]
+    if op == "^":
+        if major > 0 or minor is None:
+            return [(">=", low), ("<", Version(major + 1, 0, 0, ("0",)))]
+        if minor > 0 or patch is None:
+            return [(">=", low), ("<", Version(0, minor + 1, 0, ("0",)))]
+        return [(">=", low), ("<", Version(0, 0, patch + 1, ("0",)))]
+
+    if patch is not None:
+        return [(op or "=", low)]
+    # Partial versions (1 / 1.2) behave like x-ranges
+    high = (Version(major + 1, 0, 0, ("0",)) if minor is None
+            else Version(major, minor + 1, 0, ("0",)))
+    if op in ("", "="):
+        return [(">=", low), ("<", high)]
+    if op == ">":
+        return [(">=", Version(high.major, high.minor, high.patch))]
+    if op == ">=":
+        return [(">=", low)]
+    if op == "<":
+        return [("<", Version(low.major, low.minor, low.patch, ("0",)))]
+    if op == "<=":
+        return [("<", high)]
+    return None
+
+
+def parse_range(spec: str) -> list[list[Comparator]] | None:
+    """Parse a package.json range; None if *spec* is not a semver range."""
+    if spec is None:
+        return None
+    alternatives = []
+    for part in spec.split("||"):
+        part = part.strip()
+        hyphen = _HYPHEN_RE.match(part)
+        if hyphen:
+            low, high = _partial(hyphen.group(1)), _partial(hyphen.group(2))
+            if low is None or high is None:
+                return None
+            comparators = [(">=", _floor(*low))]
+            if high[0] is not None:
+                if high[2] is not None:
+                    comparators.append(("<=", _floor(*high)))
+                elif high[1] is not None:
+                    comparators.append(("<", Version(high[0], high[1] + 1, 0, ("0",))))
+                else:
+                    comparators.append(("<", Version(high[0] + 1, 0, 0, ("0",))))
+            alternatives.append(comparators)
+            continue
+        # Allow whitespace between an operator and its version (">= 1.2")
+        part = re.sub(r"(<=|>=|<|>|=|\^|~>?)\s+", r"\1", part)
+        comparators = []
+        for token in part.split() or [""]:
+            op, text = _COMPARATOR_RE.match(token).groups()
+            expanded = _expand(op or "", text)
+            if expanded is None:
+                return None
+            comparators += expanded
+        alternatives.append(comparators)
+    return alternatives
+
+
+def _test(op: str, version: Version, bound: Version) -> bool:
+    a, b = version.key, bound.key
+    return {"<": a < b, "<=": a <= b, ">": a > b, ">=": a >= b, "=": a == b}[op]
+
+
+def satisfies(version: Version | str, spec) -> bool | None:
+    """Whether *version* matches *spec* (a range string or parsed range).
+
+    Returns None when either side cannot be parsed.
+    """
+    if isinstance(version, str):
+        version = parse_version(version)
+    ranges = parse_range(spec) if isinstance(spec, str) else spec
+    if version is None or ranges is None:
+        return None
+    for comparators in ranges:
+        if not all(_test(op, version, bound) for op, bound in comparators):
+            continue
+        if not version.prerelease:
+            return True
+        # Prereleases only match sets that opt in on the same tuple
+        if any(bound.prerelease and bound[:3] == version[:3] and bound.prerelease != ("0",)
+               for _, bound in comparators):
+            return True
+    return False
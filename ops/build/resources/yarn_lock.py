@@ -0,0 +1,237 @@
+"""Yarn 1.x lockfile parser and editor.
+
+A yarn.lock is a sequence of blocks separated by blank lines::
+
+    "@scope/name@^1.0.0", "@scope/name@^1.2.0":
+      version "1.2.3"
+      resolved "https://..."
+      integrity sha512-...
+      dependencies:
+        other "^2.0.0"
+
+:class:`Lockfile` reads the file line by line into :class:`Entry` blocks
+(indexed by package name, every spec of a header counts) and keeps
+everything between blocks – comments, blank lines – as raw text.
+Blocks that are not edited are written back byte-for-byte, so a save
+only changes the lines that were actually touched.
+
+Edits:
+
+- :meth:`Lockfile.drop` removes a block,
+- :meth:`Lockfile.rewrite` replaces ``version`` / ``resolved`` /
+  ``integrity`` of a block in place,
+- :meth:`Lockfile.pin` makes every locked copy of a package satisfy a
+  range: specs of an out-of-range block move onto a block whose version
+  satisfies both the spec and the pin, and only specs no block can serve
+  are dropped (and re-resolved by ``yarn install``).
+
+Standard library only; used by setup_bench_apps.py and
+dedup_node_modules.py.
+"""
+
+import os
+import re
+from pathlib import Path
+
+import npm_semver  # sibling module (same directory as this script)
+
+_FIELD_RE = re.compile(r'^  (\w+) "?(.*?)"?\s*$')
+
+
+def split_spec(spec: str) -> tuple[str, str]:
+    """Split ``name@range`` (``@scope/name@range``) into (name, range)."""
+    at = spec.find("@", 1)
+    if at < 0:
+        return spec, ""
+    return spec[:at], spec[at + 1:]
+
+
+def _split_header(header: str) -> list[str]:
+    """The comma-separated, optionally quoted specs of a block header."""
+    specs, current, quoted = [], [], False
+    for char in header:
+        if char == '"':
+            quoted = not quoted
+        elif char == "," and not quoted:
+            specs.append("".join(current).strip())
+            current = []
+        else:
+            current.append(char)
+    specs.append("".join(current).strip())
+    return [spec for spec in specs if spec]
+
+
+def _quote(spec: str) -> str:
+    """Quote *spec* the way yarn does when it writes a lockfile key."""
+    if (spec.startswith(("true", "false")) or re.search(r'[:\s\n\\",\[\]]', spec)
+            or not re.match(r"[a-zA-Z]", spec)):
+        return f'"{spec}"'
+    return spec
+
+
+class Entry:
+    """One lockfile block: its header specs and its original lines."""
+
+    __slots__ = ("specs", "lines", "fields", "dirty")
+
+    def __init__(self, specs: list[str], lines: list[str]):
+        self.specs = specs
+        self.lines = lines
+        self.fields: dict[str, str] = {}
+        for line in lines[1:]:
+            match = _FIELD_RE.match(line.rstrip("\r\n"))
+            if match:
+                self.fields[match.group(1)] = match.group(2)
+        self.dirty = False
+
+    @property
+    def version(self) -> str | None:
+        return self.fields.get("version")
+
+    @property
+    def names(self) -> list[str]:
+        """Package names the header specs refer to (usually exactly one)."""
+        return list(dict.fromkeys(split_spec(spec)[0] for spec in self.specs))
+
+    def ranges(self, name: str) -> list[str]:
+        """The ranges locked by this block for *name*."""
+        return [rng for spec_name, rng in map(split_spec, self.specs) if spec_name == name]
+
+    def satisfies(self, spec: str) -> bool | None:
+        """Whether the locked version matches range *spec* (None: unknown)."""
+        return npm_semver.satisfies(self.version or "", spec)
+
+    def text(self) -> str:
+        if not self.dirty:
+            return "".join(self.lines)
+        newline = "\r\n" if self.lines[0].endswith("\r\n") else "\n"
+        header = ", ".join(_quote(spec) for spec in sorted(self.specs)) + ":" + newline
+        return header + "".join(self.lines[1:])
+
+
+class Lockfile:
+    """A parsed yarn.lock: raw text chunks and :class:`Entry` blocks."""
+
+    def __init__(self, path: Path | None = None):
+        self.path = path
+        self.chunks: list[str | Entry] = []
+        self.by_name: dict[str, list[Entry]] = {}
+        self.changed = False
+
+    @classmethod
+    def load(cls, path: Path) -> "Lockfile":
+        with open(path, encoding="utf-8", newline="") as f:
+            return cls.parse(f, path)
+
+    @classmethod
+    def parse(cls, lines, path: Path | None = None) -> "Lockfile":
+        """Parse an iterable of lines (an open file streams)."""
+        lock = cls(path)
+        block: list[str] | None = None
+        for line in lines:
+            if block is not None:
+                if line.startswith((" ", "\t")) and line.strip():
+                    block.append(line)
+                    continue
+                lock._add(block)
+                block = None
+            stripped = line.rstrip("\r\n")
+            if stripped.endswith(":") and not line.startswith((" ", "\t", "#")):
+                block = [line]
+            else:
+                lock.chunks.append(line)
+        if block is not None:
+            lock._add(block)
+        return lock
+
+    def _add(self, lines: list[str]) -> None:
+        entry = Entry(_split_header(lines[0].rstrip("\r\n")[:-1]), lines)
+        self.chunks.append(entry)
+        for name in entry.names:
+            self.by_name.setdefault(name, []).append(entry)
+
+    # -- queries -----------------------------------------------------------
+
+    def entries(self, name: str) -> list[Entry]:
+        """Live blocks locking *name*, in file order."""
+        return list(self.by_name.get(name, ()))
+
+    def versions(self, name: str) -> set[str]:
+        return {entry.version for entry in self.entries(name) if entry.version}
+
+    def query(self, name: str, spec: str) -> list[Entry]:
+        """Blocks of *name* whose locked version satisfies range *spec*."""
+        return [entry for entry in self.entries(name) if entry.satisfies(spec)]
+
+    # -- edits -------------------------------------------------------------
+
+    def drop(self, entry: Entry) -> None:
+        i = self.chunks.index(entry)
+        del self.chunks[i]
+        # Along with the blank line that separated it from the next block
+        if i < len(self.chunks) and isinstance(self.chunks[i], str) and not self.chunks[i].strip():
+            del self.chunks[i]
+        for name in entry.names:
+            self.by_name[name].remove(entry)
+            if not self.by_name[name]:
+                del self.by_name[name]
+        self.changed = True
+
+    def rewrite(self, entry: Entry, **fields: str) -> None:
+        """Replace existing ``version`` / ``resolved`` / ``integrity`` lines."""
+        for i, line in enumerate(entry.lines[1:], 1):
+            match = _FIELD_RE.match(line.rstrip("\r\n"))
+            if match and match.group(1) in fields:
+                key, value = match.group(1), fields[match.group(1)]
+                newline = line[len(line.rstrip("\r\n")):]
+                text = f'"{value}"' if key != "integrity" else value
+                entry.lines[i] = f"  {key} {text}{newline}"
+                entry.fields[key] = value
+        self.changed = True
+
+    def pin(self, name: str, spec: str | None = None) -> tuple[int, int]:
+        """Make every locked copy of *name* satisfy range *spec*.
+
+        Out-of-range specs move to the highest in-range block that also
+        satisfies the spec's own range; the rest are dropped so that yarn
+        resolves them again.  Without a usable *spec* (None or not a
+        semver range) every block of *name* is dropped.  Returns
+        (specs moved, blocks dropped).
+        """
+        moved = dropped = 0
+        if spec is None or npm_semver.parse_range(spec) is None:
+            for entry in self.entries(name):
+                self.drop(entry)
+                dropped += 1
+            return moved, dropped
+        keep = sorted(self.query(name, spec),
+                      key=lambda entry: npm_semver.parse_version(entry.version).key,
+                      reverse=True)
+        for entry in self.entries(name):
+            if entry in keep:
+                continue
+            for own in [s for s in entry.specs if split_spec(s)[0] == name]:
+                target = next((k for k in keep if k.satisfies(split_spec(own)[1])), None)
+                if target is not None:
+                    target.specs.append(own)
+                    target.dirty = True
+                    moved += 1
+            self.drop(entry)
+            dropped += 1
+        return moved, dropped
+
+    # -- output ------------------------------------------------------------
+
+    def text(self) -> str:
+        return "".join(c if isinstance(c, str) else c.text() for c in self.chunks)
+
+    def save(self, path: Path | None = None) -> bool:
+        """Write the lockfile back if it changed; returns whether it did."""
+        path = path or self.path
+        if not self.changed and path == self.path:
+            return False
+        tmp = Path(f"{path}.tmp")
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            f.write(self.text())
+        os.replace(tmp, path)
+        return True
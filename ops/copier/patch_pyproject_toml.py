@@ -76,6 +76,21 @@ packages = []
 # Packages uninstalled from the dev image venv
 # packages = ["jedi", "parso"]
 packages = []
+
+[tool.ops.overrides.node-modules-cleanup]
+# Extra / suppressed file cleanup rules for dedup_node_modules.py (glob
+# patterns matched against directory and file names in node_modules).
+# keep-* always wins over the built-in and extra remove rules.
+remove-dirs = []                # e.g. ["docs", "fixtures"]
+remove-files = []               # e.g. ["*.d.ts", "*.flow"]
+keep-dirs = []
+keep-files = []                 # e.g. ["LICENSE*"]
+
+[tool.ops.overrides.node-modules-runtime]
+# Release image: node_modules are pruned to what these Node entry points
+# (relative to apps/, added to frappe's socketio.js + realtime/) require.
+entry-points = []
+keep = []                       # packages always kept, with their dependencies
 """
 
 
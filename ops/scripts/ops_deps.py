@@ -21,6 +21,16 @@ The version field accepts either:
 
 Build-script configuration lives in [tool.ops.overrides] sections.
 Scripts read these values at build time via read_toml.py.
+
+The update commands cache what they learn upstream (latest versions per
+index, frappe tags) in ops/.cache/deps-metadata.json.  Local sources (an
+index directory or file:// URL, a mirror path or tags file) are read
+directly every time and never cached.  Where to query and
+for how long answers stay current can be set in [tool.ops.deps]:
+    [tool.ops.deps]
+    index-url = "../wheelhouse/simple"    # PEP 503 index: URL or directory
+    frappe-repo = "/var/cache/ops/git/frappe.git"   # mirror or tags file
+    cache-ttl = 12                        # hours
 """
 
 import json
@@ -28,11 +38,16 @@ import re
 import subprocess
 import sys
 import tempfile
+import time
+from fnmatch import fnmatch
 from pathlib import Path
 
 import click
 
 PIN_MARKER = "# auto-pin: ops deps"
+FRAPPE_REPO = "https://github.com/frappe/frappe.git"
+# How long cached index responses / frappe tags count as current
+DEFAULT_CACHE_TTL_HOURS = 12
 
 # ---------------------------------------------------------------------------
 # Path helpers
@@ -55,7 +70,7 @@ def _get_app_name() -> str:
 
 
 # ---------------------------------------------------------------------------
-# pip helpers (read-only — never installs)
+# pip / metadata helpers (read-only — never installs)
 # ---------------------------------------------------------------------------
 
 def _find_bench_pip() -> str | None:
@@ -73,19 +88,57 @@ def _find_pip() -> str:
     return shutil.which("pip") or sys.executable
 
 
-def _installed_versions(pip: str) -> dict[str, str]:
-    """Return {normalised_name: version} for all installed packages."""
-    result = subprocess.run([pip, "list", "--format=json"], capture_output=True, text=True)
-    if result.returncode != 0:
-        return {}
-    return {_norm(p["name"]): p["version"] for p in json.loads(result.stdout)}
+def _site_packages_dirs() -> list[Path]:
+    """site-packages of the bench venv, or of the current env without one."""
+    bench_env = _bench_root() / "env"
+    if bench_env.is_dir():
+        return sorted(p for p in bench_env.glob("lib/python*/site-packages") if p.is_dir())
+    import site
+    return [Path(p) for p in site.getsitepackages() if Path(p).is_dir()]
+
 
+def _installed_versions() -> dict[str, str]:
+    """Return {normalised_name: version} for all installed packages.
+
+    Reads the ``*.dist-info`` metadata of the bench venv directly (no pip
+    or interpreter start-up).  The result is cached in
+    ops/.cache/installed-versions.json, keyed on the site-packages mtime,
+    which changes whenever a distribution is installed or removed.
+    """
+    from importlib.metadata import distributions
+
+    dirs = _site_packages_dirs()
+    key = [[str(d), d.stat().st_mtime_ns] for d in dirs]
+    cache = _get_app_root() / "ops" / ".cache" / "installed-versions.json"
+    try:
+        cached = json.loads(cache.read_text())
+        if cached.get("key") == key:
+            return cached["versions"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    versions: dict[str, str] = {}
+    for dist in distributions(path=[str(d) for d in dirs]):
+        name = dist.metadata["Name"]
+        if name and dist.version:
+            versions.setdefault(_norm(name), dist.version)
 
-def _query_latest_versions(pip: str, packages: list[str], pre: bool = False) -> dict[str, str]:
+    if versions:
+        try:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            cache.write_text(json.dumps({"key": key, "versions": versions}))
+        except OSError:
+            pass
+    return versions
+
+
+def _query_latest_versions(pip: str, packages: list[str], pre: bool = False,
+                           index_url: str | None = None) -> dict[str, str] | None:
     """Query latest available versions via pip install --dry-run --report.
 
     Uses --dry-run so nothing is actually installed.  Returns
-    {normalised_name: latest_version} for packages that would be upgraded.
+    {normalised_name: latest_version} for packages that would be upgraded,
+    or None if pip could not answer.
     """
     if not packages:
         return {}
@@ -96,6 +149,8 @@ def _query_latest_versions(pip: str, packages: list[str], pre: bool = False) ->
     cmd = [pip, "install", "--dry-run", "--upgrade", "--report", str(report_path)]
     if pre:
         cmd.append("--pre")
+    if index_url:
+        cmd.extend(["--index-url", index_url])
     cmd.extend(packages)
 
     result = subprocess.run(cmd, capture_output=True, text=True)
@@ -112,6 +167,7 @@ def _query_latest_versions(pip: str, packages: list[str], pre: bool = False) ->
     except (json.JSONDecodeError, FileNotFoundError):
         if result.returncode != 0:
             click.echo(f"⚠️  pip query failed: {result.stderr.strip()}", err=True)
+            return None
     finally:
         report_path.unlink(missing_ok=True)
 
@@ -123,6 +179,114 @@ def _norm(name: str) -> str:
     return re.sub(r"[-_.]+", "-", name).lower()
 
 
+# ---------------------------------------------------------------------------
+# Upstream metadata cache (ops/.cache/deps-metadata.json)
+# ---------------------------------------------------------------------------
+#
+# {"index": {"<index>|<stable|pre>": {"<package>": {"version": "1.2.3" | null,
+#                                                  "fetched": <epoch>}}},
+#  "frappe-tags": {"<repo>|<pattern>": {"tags": [...], "fetched": <epoch>}}}
+#
+# A null version means "nothing newer than what was installed", which is
+# how pip reports an up-to-date package.
+
+def _metadata_cache_path() -> Path:
+    return _get_app_root() / "ops" / ".cache" / "deps-metadata.json"
+
+
+def _load_metadata_cache() -> dict:
+    try:
+        return json.loads(_metadata_cache_path().read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_metadata_cache(cache: dict):
+    path = _metadata_cache_path()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(cache, indent=1, sort_keys=True))
+    except OSError:
+        pass
+
+
+def _is_fresh(entry: dict | None, ttl_hours: float) -> bool:
+    return bool(entry) and time.time() - entry.get("fetched", 0) < ttl_hours * 3600
+
+
+def _local_source(value: str | None) -> str | None:
+    """Resolve a directory or file given relative to the app root."""
+    if not value or "://" in value or value.startswith("git@"):
+        return value
+    path = Path(value).expanduser()
+    if not path.is_absolute():
+        path = _get_app_root() / path
+    return str(path.resolve())
+
+
+def _is_local(source: str | None) -> bool:
+    """True for a local path or file:// URL (read directly, not cached)."""
+    if not source:
+        return False
+    return source.startswith("file://") or ("://" not in source and not source.startswith("git@"))
+
+
+def _latest_versions(packages: list[str], pre: bool, index_url: str | None,
+                     ttl_hours: float, offline: bool,
+                     refresh: bool) -> tuple[dict[str, str], set[str]]:
+    """Latest versions of *packages*, from the cache where it is current.
+
+    Only packages without a current cache entry go to pip (one resolve for
+    all of them), against *index_url* if given (a PEP 503 simple index URL
+    or directory).  Offline, only a local index is queried; entries past
+    their TTL are then used as last-known answers, as they are when pip
+    fails.  A local index bypasses the cache: it is cheap to read and the
+    cache would hide its updates.
+    Returns ({normalised_name: version}, names nothing is known about).
+    """
+    if index_url and "://" not in index_url:
+        index_url = Path(index_url).as_uri()
+    if _is_local(index_url):
+        found = _query_latest_versions(_find_pip(), packages, pre=pre, index_url=index_url)
+        if found is None:
+            return {}, {_norm(name) for name in packages}
+        return found, set()
+    cache = _load_metadata_cache()
+    section = cache.setdefault("index", {}).setdefault(
+        f"{index_url or 'pypi'}|{'pre' if pre else 'stable'}", {})
+
+    versions: dict[str, str] = {}
+    todo = []
+    for name in packages:
+        entry = section.get(_norm(name))
+        if not refresh and _is_fresh(entry, ttl_hours):
+            if entry["version"]:
+                versions[_norm(name)] = entry["version"]
+        else:
+            todo.append(name)
+    if len(todo) < len(packages):
+        click.echo(f"   ({len(packages) - len(todo)} answered from the metadata cache)\n")
+
+    if todo and not offline:
+        found = _query_latest_versions(_find_pip(), todo, pre=pre, index_url=index_url)
+        if found is not None:
+            now = time.time()
+            for name in todo:
+                section[_norm(name)] = {"version": found.get(_norm(name)), "fetched": now}
+            versions.update(found)
+            _save_metadata_cache(cache)
+            todo = []
+
+    stale = [name for name in todo if _norm(name) in section]
+    for name in stale:
+        if section[_norm(name)]["version"]:
+            versions[_norm(name)] = section[_norm(name)]["version"]
+    if stale:
+        click.echo(f"   ⚠️  {len(stale)} packages answered from expired cache entries\n")
+    unknown = {_norm(name) for name in todo if _norm(name) not in section}
+    return versions, unknown
+
+
 # ---------------------------------------------------------------------------
 # pyproject.toml line-level parsing
 # ---------------------------------------------------------------------------
@@ -212,15 +376,20 @@ def _frappe_installed_version() -> str | None:
     return m.group(1) if m else None
 
 
-def _read_ops_frappe(pyproject: Path) -> dict:
-    """Read [tool.ops.frappe] from pyproject.toml via tomllib."""
+def _read_ops_section(pyproject: Path, name: str) -> dict:
+    """Read [tool.ops.<name>] from pyproject.toml via tomllib."""
     try:
         import tomllib
     except ImportError:
         import tomli as tomllib  # type: ignore[no-redef]
     with open(pyproject, "rb") as f:
         data = tomllib.load(f)
-    return data.get("tool", {}).get("ops", {}).get("frappe", {})
+    return data.get("tool", {}).get("ops", {}).get(name, {})
+
+
+def _read_ops_frappe(pyproject: Path) -> dict:
+    """Read [tool.ops.frappe] from pyproject.toml."""
+    return _read_ops_section(pyproject, "frappe")
 
 
 def _write_frappe_field(pyproject: Path, field: str, value: str):
@@ -263,36 +432,80 @@ def _frappe_git_ref(version: str) -> str:
     return f"v{version}"
 
 
-def _query_frappe_latest_version(branch: str) -> str | None:
-    """Query the latest frappe version tag for a branch via git ls-remote.
+def _list_frappe_tags(repo: str, pattern: str) -> list[str] | None:
+    """Tags of *repo* matching *pattern*; None if they cannot be read.
 
-    Extracts the major version from the branch name (e.g. "version-15" → 15)
-    and finds the highest matching tag on GitHub.
+    *repo* is anything git ls-remote accepts (URL, local mirror) or a text
+    file with one tag per line, e.g. saved ``git ls-remote --tags`` output.
     """
-    FRAPPE_REPO = "https://github.com/frappe/frappe.git"
+    if Path(repo).is_file():
+        lines = Path(repo).read_text().splitlines()
+    else:
+        try:
+            result = subprocess.run(
+                ["git", "ls-remote", "--tags", repo, pattern],
+                capture_output=True, text=True, timeout=30,
+            )
+        except (subprocess.TimeoutExpired, FileNotFoundError):
+            return None
+        if result.returncode != 0:
+            return None
+        lines = result.stdout.splitlines()
+
+    tags = []
+    for line in lines:
+        if not line.strip() or "^{}" in line:
+            continue
+        tag = line.split()[-1].removeprefix("refs/tags/")
+        if fnmatch(tag, pattern):
+            tags.append(tag)
+    return tags
+
 
+def _query_frappe_latest_version(branch: str, repo: str = FRAPPE_REPO,
+                                 ttl_hours: float = DEFAULT_CACHE_TTL_HOURS,
+                                 offline: bool = False, refresh: bool = False) -> str | None:
+    """Query the latest frappe version tag for a branch.
+
+    Extracts the major version from the branch name (e.g. "version-15" → 15)
+    and finds the highest matching tag in *repo* (GitHub by default).  The
+    tag list of a remote repo is cached; offline, or when the repo cannot
+    be read, the last-known list is used whatever its age.  A local mirror
+    or tags file is read directly every time.
+    """
     m = re.match(r"version-(\d+)", branch)
     tag_pattern = f"v{m.group(1)}.*" if m else "v*"
 
-    try:
-        result = subprocess.run(
-            ["git", "ls-remote", "--tags", FRAPPE_REPO, tag_pattern],
-            capture_output=True, text=True, timeout=30,
-        )
-    except (subprocess.TimeoutExpired, FileNotFoundError):
-        return None
+    if _is_local(repo):
+        tags = _list_frappe_tags(repo, tag_pattern)
+        return _highest_version(tags) if tags is not None else None
+
+    cache = _load_metadata_cache()
+    section = cache.setdefault("frappe-tags", {})
+    key = f"{repo}|{tag_pattern}"
+    entry = section.get(key)
+
+    if not refresh and _is_fresh(entry, ttl_hours):
+        click.echo("   (tags from the metadata cache)")
+        tags = entry["tags"]
+    else:
+        tags = None if offline else _list_frappe_tags(repo, tag_pattern)
+        if tags is not None:
+            section[key] = {"tags": tags, "fetched": time.time()}
+            _save_metadata_cache(cache)
+        elif entry:
+            click.echo("   ⚠️  Using the last-known frappe tags (expired cache entry)")
+            tags = entry["tags"]
+        else:
+            return None
+    return _highest_version(tags)
 
-    if result.returncode != 0:
-        return None
 
+def _highest_version(tags: list[str]) -> str | None:
+    """The highest numeric ``vX.Y.Z`` tag in *tags*, without the ``v``."""
     versions: list[tuple[tuple[int, ...], str]] = []
-    for line in result.stdout.splitlines():
-        if "^{}" in line:
-            continue
-        parts = line.split("\t")
-        if len(parts) != 2:
-            continue
-        tag = parts[1].removeprefix("refs/tags/v")
+    for tag in tags:
+        tag = tag.removeprefix("v")
         try:
             ver_tuple = tuple(int(x) for x in tag.split("."))
             versions.append((ver_tuple, tag))
@@ -345,9 +558,8 @@ def deps_status():
         click.echo("❌ No dependencies block found in pyproject.toml")
         sys.exit(1)
 
-    pip = _find_pip()
-    versions = _installed_versions(pip)
-    pip_label = "bench venv" if _find_bench_pip() else "current env"
+    versions = _installed_versions()
+    pip_label = "bench venv" if (_bench_root() / "env").is_dir() else "current env"
 
     click.echo(f"📦 Dependencies (pyproject.toml)  —  pip source: {pip_label}\n")
 
@@ -422,8 +634,7 @@ def deps_fix():
         click.echo("❌ No dependencies block found")
         sys.exit(1)
 
-    pip = _find_pip()
-    versions = _installed_versions(pip)
+    versions = _installed_versions()
 
     if not versions:
         click.echo("❌ Could not read installed packages. Are you in the right environment?")
@@ -502,7 +713,9 @@ def deps_free():
         click.echo("   🔓 frappe version cleared (tracks branch HEAD)")
 
 
-def _do_update(pre: bool = False):
+def _do_update(pre: bool = False, offline: bool = False, refresh: bool = False,
+               index_url: str | None = None, frappe_repo: str | None = None,
+               cache_ttl: float | None = None):
     """Shared logic for update-stable and update-experimental.
 
     Queries available versions via pip --dry-run (never installs anything),
@@ -511,6 +724,9 @@ def _do_update(pre: bool = False):
 
     Also queries the latest frappe version tag for the configured branch
     via git ls-remote and updates [tool.ops.frappe] version accordingly.
+
+    Answers are cached (see _latest_versions); options not given on the
+    command line default to [tool.ops.deps].
     """
     pyproject = _pyproject_path()
     lines = pyproject.read_text().splitlines(keepends=True)
@@ -520,23 +736,34 @@ def _do_update(pre: bool = False):
         click.echo("❌ No dependencies block found")
         sys.exit(1)
 
+    deps_cfg = _read_ops_section(pyproject, "deps")
+    index_url = _local_source(index_url or deps_cfg.get("index-url"))
+    frappe_repo = _local_source(frappe_repo or deps_cfg.get("frappe-repo")) or FRAPPE_REPO
+    if cache_ttl is None:
+        cache_ttl = float(deps_cfg.get("cache-ttl", DEFAULT_CACHE_TTL_HOURS))
+
     any_changes = False
 
     # --- pip dependencies ---
     auto_pinned = _collect_auto_pinned(lines, start, end)
     if auto_pinned:
         packages = [p["name"] for _, p in auto_pinned]
-        pip = _find_pip()
         label = "experimental (incl. pre-release)" if pre else "stable"
-        click.echo(f"🔍 Querying latest {label} versions for {len(packages)} packages...\n")
+        source = f" from {index_url}" if index_url else ""
+        click.echo(f"🔍 Querying latest {label} versions for {len(packages)} packages{source}...\n")
 
-        available = _query_latest_versions(pip, packages, pre=pre)
+        available, unknown = _latest_versions(packages, pre, index_url, cache_ttl,
+                                               offline, refresh)
 
+        why_unknown = "index unreadable" if _is_local(index_url) else "offline and not cached"
         pip_updated = 0
         for i, p in auto_pinned:
             current_ver = p["version"]
             latest = available.get(_norm(p["name"]))
 
+            if _norm(p["name"]) in unknown:
+                click.echo(f"   ?  {p['name']}{current_ver} (no metadata: {why_unknown})")
+                continue
             if not latest:
                 click.echo(f"   ✓  {p['name']}{current_ver} (up to date)")
                 continue
@@ -566,10 +793,16 @@ def _do_update(pre: bool = False):
 
     if branch:
         click.echo(f"\n🔍 Querying latest frappe version for branch '{branch}'...")
-        latest_frappe = _query_frappe_latest_version(branch)
+        latest_frappe = _query_frappe_latest_version(branch, frappe_repo, cache_ttl,
+                                                     offline, refresh)
 
         if latest_frappe is None:
-            click.echo("   ⚠️  Could not query frappe tags (no network or git not found)")
+            if _is_local(frappe_repo):
+                click.echo(f"   ⚠️  Could not read frappe tags from {frappe_repo}")
+            elif offline:
+                click.echo("   ⚠️  No cached frappe tags (offline)")
+            else:
+                click.echo("   ⚠️  Could not query frappe tags (no network or git not found)")
         elif not current_frappe:
             _write_frappe_field(pyproject, "version", latest_frappe)
             click.echo(f"   📌 frappe: (none) → {latest_frappe}  (tag: v{latest_frappe})")
@@ -590,21 +823,47 @@ def _do_update(pre: bool = False):
         click.echo("\n   Everything already at latest versions.")
 
 
+def _update_options(f):
+    """Metadata source and cache options shared by the update commands."""
+    options = [
+        click.option("--offline", is_flag=True,
+                     help="Never use the network: answer from the metadata cache "
+                          "(whatever its age); a local index directory, mirror path "
+                          "or tags file is still read."),
+        click.option("--refresh", is_flag=True,
+                     help="Ignore the metadata cache and query again."),
+        click.option("--index-url", default=None,
+                     help="PEP 503 simple index (URL or local directory) to query "
+                          "instead of PyPI.  Default: [tool.ops.deps] index-url."),
+        click.option("--frappe-repo", default=None,
+                     help="Frappe repo URL, local mirror or tags file to read the "
+                          "version tags from.  Default: [tool.ops.deps] frappe-repo."),
+        click.option("--cache-ttl", type=float, default=None,
+                     help="Hours cached answers count as current "
+                          f"(default: [tool.ops.deps] cache-ttl or {DEFAULT_CACHE_TTL_HOURS})."),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
 @deps.command("update-stable")
-def deps_update_stable():
+@_update_options
+def deps_update_stable(**options):
     """Update auto-pinned dependencies to latest stable versions.
 
     Queries available versions via pip (dry-run, nothing is installed),
     updates the version pins in pyproject.toml, and prints the command
     for you to run after reviewing the changes.
     """
-    _do_update(pre=False)
+    _do_update(pre=False, **options)
 
 
 @deps.command("update-experimental")
-def deps_update_experimental():
+@_update_options
+def deps_update_experimental(**options):
     """Update auto-pinned deps to latest versions (including pre-release).
 
     Same as update-stable but considers pre-release versions.
     """
-    _do_update(pre=True)
+    _do_update(pre=True, **options)